@@ -0,0 +1,237 @@
+from __future__ import annotations
+import json
+import math
+import os
+from collections import Counter
+from typing import Dict, Iterable, List, Sequence
+
+import numpy as np
+import regex as re
+
+_WORD = re.compile(r"\p{L}+\p{M}*|\d+", re.UNICODE)
+
+
+def _tokenize(text: str) -> List[str]:
+    # tokenizer đơn giản cho TV: lấy chuỗi chữ (có dấu) & số → lower
+    return [t.lower() for t in _WORD.findall(text or "")]
+
+
+class BM25Index:
+    """
+    Inverted index BM25 (Okapi) cập nhật tăng dần theo từng dòng của vector store.
+    - postings: term -> {row: tf}
+    - doc_len: mảng int32 theo số dòng (số token, -1 = dòng không có trong index),
+      để get_scores lấy độ dài cả postings bằng một phép index numpy
+    - bảng IDF tính lại lười (chỉ khi index thay đổi)
+    Công thức giống rank_bm25.BM25Okapi (k1=1.5, b=0.75, epsilon=0.25).
+    """
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75, epsilon: float = 0.25):
+        self.k1 = k1
+        self.b = b
+        self.epsilon = epsilon
+        self.postings: Dict[str, Dict[int, int]] = {}
+        self.doc_len = np.full(0, -1, dtype=np.int32)
+        self._n_docs = 0
+        self._total_len = 0
+        self._n_postings = 0
+        self._idf: Dict[str, float] | None = None
+
+    def __len__(self) -> int:
+        return self._n_docs
+
+    @property
+    def avgdl(self) -> float:
+        return self._total_len / self._n_docs if self._n_docs else 0.0
+
+    def _has_row(self, row: int) -> bool:
+        return 0 <= row < self.doc_len.shape[0] and self.doc_len[row] >= 0
+
+    def _reserve(self, size: int) -> None:
+        """Nới mảng doc_len (gấp đôi) để chứa được `size` dòng."""
+        if size <= self.doc_len.shape[0]:
+            return
+        grown = np.full(max(size, 2 * self.doc_len.shape[0], 64), -1, dtype=np.int32)
+        grown[: self.doc_len.shape[0]] = self.doc_len
+        self.doc_len = grown
+
+    def add(self, row: int, text: str) -> None:
+        tokens = _tokenize(text)
+        tf: Dict[str, int] = {}
+        for t in tokens:
+            tf[t] = tf.get(t, 0) + 1
+        for t, c in tf.items():
+            self.postings.setdefault(t, {})[row] = c
+        self._reserve(row + 1)
+        if self.doc_len[row] >= 0:
+            self._total_len -= int(self.doc_len[row])
+        else:
+            self._n_docs += 1
+        self.doc_len[row] = len(tokens)
+        self._total_len += len(tokens)
+        self._n_postings += len(tf)
+        self._idf = None
+
+    def add_many(self, rows: Iterable[int], texts: Iterable[str]) -> None:
+        for row, text in zip(rows, texts):
+            self.add(row, text)
+
+    def remove(self, rows: Sequence[int], texts: Sequence[str]) -> None:
+        """Xoá các dòng; chỉ chạm vào postings của các term trong text bị xoá."""
+        for row, text in zip(rows, texts):
+            if not self._has_row(row):
+                continue
+            for t in set(_tokenize(text)):
+                plist = self.postings.get(t)
+                if plist is None:
+                    continue
+                if plist.pop(row, None) is not None:
+                    self._n_postings -= 1
+                if not plist:
+                    del self.postings[t]
+            self._total_len -= int(self.doc_len[row])
+            self.doc_len[row] = -1
+            self._n_docs -= 1
+        self._idf = None
+
+    def renumber(self, mapping: Dict[int, int]) -> None:
+        """Đánh lại số dòng (old -> new) sau khi vector store bị nén lại."""
+        self.postings = {
+            t: {mapping[r]: c for r, c in plist.items() if r in mapping}
+            for t, plist in self.postings.items()
+        }
+        self.postings = {t: p for t, p in self.postings.items() if p}
+        old = np.fromiter(mapping.keys(), dtype=np.int64, count=len(mapping))
+        new = np.fromiter(mapping.values(), dtype=np.int64, count=len(mapping))
+        keep = old < self.doc_len.shape[0]
+        old, new = old[keep], new[keep]
+        lens = self.doc_len[old]
+        keep = lens >= 0
+        new, lens = new[keep], lens[keep]
+        self.doc_len = np.full(int(new.max()) + 1 if new.size else 0, -1, dtype=np.int32)
+        self.doc_len[new] = lens
+        self._n_docs = int(new.size)
+        self._total_len = int(lens.sum(dtype=np.int64))
+        self._n_postings = sum(len(p) for p in self.postings.values())
+        self._idf = None
+
+    def copy(self) -> "BM25Index":
+        """Bản sao độc lập (dùng khi ghi snapshot ở thread nền)."""
+        idx = BM25Index(k1=self.k1, b=self.b, epsilon=self.epsilon)
+        idx.postings = {t: dict(p) for t, p in self.postings.items()}
+        idx.doc_len = self.doc_len.copy()
+        idx._n_docs = self._n_docs
+        idx._total_len = self._total_len
+        idx._n_postings = self._n_postings
+        return idx
+
+    def clear(self) -> None:
+        self.postings = {}
+        self.doc_len = np.full(0, -1, dtype=np.int32)
+        self._n_docs = 0
+        self._total_len = 0
+        self._n_postings = 0
+        self._idf = None
+
+    def approx_bytes(self) -> int:
+        """Ước lượng RAM của dict postings (~100 byte/entry, ~150 byte/term) cộng mảng doc_len."""
+        return 100 * self._n_postings + 150 * len(self.postings) + self.doc_len.nbytes
+
+    def _ensure_idf(self) -> Dict[str, float]:
+        if self._idf is not None:
+            return self._idf
+        n_docs = self._n_docs
+        idf: Dict[str, float] = {}
+        negatives = []
+        total = 0.0
+        for t, plist in self.postings.items():
+            df = len(plist)
+            val = math.log(n_docs - df + 0.5) - math.log(df + 0.5)
+            idf[t] = val
+            total += val
+            if val < 0:
+                negatives.append(t)
+        # giống BM25Okapi: idf âm được thay bằng epsilon * idf trung bình
+        eps = self.epsilon * (total / len(idf)) if idf else 0.0
+        for t in negatives:
+            idf[t] = eps
+        self._idf = idf
+        return idf
+
+    def get_scores(self, query_tokens: Iterable[str], rows: np.ndarray) -> np.ndarray:
+        """
+        Điểm BM25 cho từng dòng trong `rows` (cùng thứ tự).
+        Chỉ duyệt postings của các term trong câu hỏi.
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        scores = np.zeros(rows.shape[0], dtype=np.float32)
+        if rows.size == 0 or not self._n_docs:
+            return scores
+        idf = self._ensure_idf()
+        # row -> vị trí trong `rows` (-1 = không thuộc tập ứng viên)
+        pos = np.full(int(rows.max()) + 1, -1, dtype=np.int64)
+        pos[rows] = np.arange(rows.shape[0])
+        avgdl = self.avgdl or 1.0
+        k1, b = self.k1, self.b
+        # BM25Okapi cộng dồn theo từng token của câu hỏi (kể cả lặp lại)
+        for t, qf in Counter(query_tokens).items():
+            plist = self.postings.get(t)
+            if not plist:
+                continue
+            p_rows = np.fromiter(plist.keys(), dtype=np.int64, count=len(plist))
+            p_tf = np.fromiter(plist.values(), dtype=np.float32, count=len(plist))
+            keep = p_rows < pos.shape[0]
+            p_rows, p_tf = p_rows[keep], p_tf[keep]
+            ix = pos[p_rows]
+            keep = ix >= 0
+            if not keep.any():
+                continue
+            p_rows, p_tf, ix = p_rows[keep], p_tf[keep], ix[keep]
+            dl = self.doc_len[p_rows].astype(np.float32)
+            w = qf * idf.get(t, 0.0)
+            scores[ix] += w * (p_tf * (k1 + 1)) / (p_tf + k1 * (1 - b + b * dl / avgdl))
+        return scores
+
+    def matching_rows(self, query_tokens: Iterable[str]) -> np.ndarray:
+        """Các dòng chứa ít nhất một term của câu hỏi (hợp các postings)."""
+        lists = [
+            np.fromiter(p.keys(), dtype=np.int64, count=len(p))
+            for p in (self.postings.get(t) for t in set(query_tokens))
+            if p
+        ]
+        if not lists:
+            return np.zeros(0, dtype=np.int64)
+        return np.unique(np.concatenate(lists))
+
+    # ---- persistence ----
+    def save(self, path: str) -> None:
+        data = {
+            "k1": self.k1,
+            "b": self.b,
+            "epsilon": self.epsilon,
+            "doc_len": [[r, int(self.doc_len[r])] for r in np.flatnonzero(self.doc_len >= 0).tolist()],
+            "postings": {t: [[r, c] for r, c in p.items()] for t, p in self.postings.items()},
+        }
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as w:
+            json.dump(data, w, ensure_ascii=False)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path: str) -> "BM25Index":
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        idx = cls(
+            k1=data.get("k1", 1.5), b=data.get("b", 0.75), epsilon=data.get("epsilon", 0.25)
+        )
+        pairs = np.asarray(data.get("doc_len", []), dtype=np.int64).reshape(-1, 2)
+        idx._reserve(int(pairs[:, 0].max()) + 1 if pairs.size else 0)
+        idx.doc_len[pairs[:, 0]] = pairs[:, 1]
+        idx._n_docs = int(pairs.shape[0])
+        idx.postings = {
+            t: {int(r): int(c) for r, c in plist}
+            for t, plist in data.get("postings", {}).items()
+        }
+        idx._total_len = int(pairs[:, 1].sum())
+        idx._n_postings = sum(len(p) for p in idx.postings.values())
+        return idx
@@ -1,44 +1,403 @@
 from __future__ import annotations
-import os, sqlite3
-from typing import Iterable, Dict, Tuple, List, Optional
+import os, sqlite3, threading, time
+from collections import OrderedDict
+from contextlib import contextmanager
+from queue import Empty, Queue
+from typing import Iterable, Dict, Tuple, List
 
 import numpy as np
 
+from app.utils.config import get_int, get_float
+
+# Cache embedding 2 tầng:
+# - tầng 1: LRU trong RAM theo (db_path, namespace, key) với ngân sách EMBED_MEM_CACHE_MB
+# - tầng 2: SQLite embed_cache_v2 qua pool kết nối dùng lâu dài (CREATE TABLE/PRAGMA chỉ chạy
+#   khi mở kết nối, không phải mỗi lần gọi)
+# Namespace = "<backend:model>|<task_type>" nên đổi model/task không trả nhầm vector.
+# Vector lưu float32 hoặc float16 (EMBED_CACHE_DTYPE); ts = lần dùng gần nhất, dùng để
+# bỏ entry cũ nhất khi vượt EMBED_CACHE_MAX_MB. Tổng byte vector nằm trong
+# embed_cache_meta('payload_bytes'), được trigger cập nhật theo từng insert/update/delete,
+# nên kiểm tra dung lượng không phải quét cả bảng.
+
+# bảng cũ embed_cache(k, dim, vec) không có namespace: chỉ đọc (và chuyển dần sang v2)
+# cho namespace LEGACY_EMBED_NAMESPACE
+_LEGACY_NAMESPACE_DEFAULT = "gemini:text-embedding-004|retrieval_document"
+_DTYPES = {"f4": np.float32, "f2": np.float16}
+_TOUCH_EVERY_S = 3600
+
 def _connect(db_path: str) -> sqlite3.Connection:
     os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
-    con = sqlite3.connect(db_path, timeout=30)
+    con = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
     con.execute("""
-        CREATE TABLE IF NOT EXISTS embed_cache (
-            k TEXT PRIMARY KEY,
+        CREATE TABLE IF NOT EXISTS embed_cache_v2 (
+            ns TEXT NOT NULL,
+            k TEXT NOT NULL,
             dim INTEGER NOT NULL,
-            vec BLOB NOT NULL
+            dtype TEXT NOT NULL,
+            vec BLOB NOT NULL,
+            ts INTEGER NOT NULL,
+            PRIMARY KEY (ns, k)
+        )
+    """)
+    con.execute("CREATE INDEX IF NOT EXISTS embed_cache_v2_ts ON embed_cache_v2(ts)")
+    con.execute("""
+        CREATE TABLE IF NOT EXISTS embed_cache_meta (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
         )
     """)
+    con.execute("""
+        CREATE TRIGGER IF NOT EXISTS embed_cache_v2_bytes_ins AFTER INSERT ON embed_cache_v2
+        BEGIN
+            UPDATE embed_cache_meta SET value = value + LENGTH(NEW.vec) WHERE name = 'payload_bytes';
+        END
+    """)
+    con.execute("""
+        CREATE TRIGGER IF NOT EXISTS embed_cache_v2_bytes_upd AFTER UPDATE OF vec ON embed_cache_v2
+        BEGIN
+            UPDATE embed_cache_meta SET value = value + LENGTH(NEW.vec) - LENGTH(OLD.vec)
+            WHERE name = 'payload_bytes';
+        END
+    """)
+    con.execute("""
+        CREATE TRIGGER IF NOT EXISTS embed_cache_v2_bytes_del AFTER DELETE ON embed_cache_v2
+        BEGIN
+            UPDATE embed_cache_meta SET value = value - LENGTH(OLD.vec) WHERE name = 'payload_bytes';
+        END
+    """)
+    if con.execute("SELECT 1 FROM embed_cache_meta WHERE name = 'payload_bytes'").fetchone() is None:
+        # file cache tạo trước khi có bộ đếm: quét một lần, từ đó trigger giữ tổng
+        con.execute(
+            "INSERT OR IGNORE INTO embed_cache_meta(name, value) "
+            "SELECT 'payload_bytes', COALESCE(SUM(LENGTH(vec)), 0) FROM embed_cache_v2"
+        )
+        con.commit()
     con.execute("PRAGMA journal_mode=WAL;")
     con.execute("PRAGMA synchronous=NORMAL;")
     return con
 
-def fetch_many(db_path: str, keys: Iterable[str]) -> Dict[str, np.ndarray]:
+def _has_legacy(con: sqlite3.Connection) -> bool:
+    row = con.execute(
+        "SELECT 1 FROM sqlite_master WHERE type='table' AND name='embed_cache'"
+    ).fetchone()
+    return row is not None
+
+def _storage_dtype() -> str:
+    return "f2" if os.getenv("EMBED_CACHE_DTYPE", "float32").strip().lower() in ("float16", "f2", "fp16") else "f4"
+
+def _decode(dim: int, dtype: str, blob: bytes) -> np.ndarray:
+    return np.frombuffer(blob, dtype=_DTYPES.get(dtype, np.float32)).astype(np.float32).reshape(dim)
+
+class _ConnectionPool:
+    """Pool nhỏ các kết nối SQLite cho một file (mỗi kết nối chỉ dùng bởi một thread tại một thời điểm)."""
+
+    def __init__(self, db_path: str, size: int):
+        self.db_path = db_path
+        self._idle: "Queue[sqlite3.Connection]" = Queue()
+        self._size = max(1, size)
+        self._opened = 0
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def connection(self):
+        try:
+            con = self._idle.get_nowait()
+        except Empty:
+            with self._lock:
+                can_open = self._opened < self._size
+                if can_open:
+                    self._opened += 1
+            if can_open:
+                try:
+                    con = _connect(self.db_path)
+                except Exception:
+                    with self._lock:
+                        self._opened -= 1
+                    raise
+            else:
+                con = self._idle.get()
+        try:
+            yield con
+        except Exception:
+            con.rollback()
+            raise
+        finally:
+            self._idle.put(con)
+
+class _MemoryLRU:
+    """LRU vector theo byte; an toàn giữa các thread."""
+
+    def __init__(self):
+        self._items: "OrderedDict[Tuple[str, str, str], np.ndarray]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    @property
+    def budget(self) -> int:
+        return max(0, get_int("EMBED_MEM_CACHE_MB", 64)) * 1024 * 1024
+
+    def get_many(self, db_path: str, namespace: str, keys: List[str]) -> Dict[str, np.ndarray]:
+        out: Dict[str, np.ndarray] = {}
+        with self._lock:
+            for k in keys:
+                v = self._items.get((db_path, namespace, k))
+                if v is not None:
+                    self._items.move_to_end((db_path, namespace, k))
+                    out[k] = v
+        return out
+
+    def put_many(self, db_path: str, namespace: str, items: Iterable[Tuple[str, np.ndarray]]) -> None:
+        budget = self.budget
+        if budget <= 0:
+            return
+        with self._lock:
+            for k, v in items:
+                old = self._items.pop((db_path, namespace, k), None)
+                if old is not None:
+                    self._bytes -= old.nbytes
+                self._items[(db_path, namespace, k)] = v
+                self._bytes += v.nbytes
+            while self._bytes > budget and self._items:
+                _, v = self._items.popitem(last=False)
+                self._bytes -= v.nbytes
+
+    def clear(self) -> None:
+        with self._lock:
+            self._items.clear()
+            self._bytes = 0
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+class _QueryCache:
+    """
+    LRU nhỏ có TTL cho embedding câu hỏi (QUERY_CACHE_SIZE, QUERY_CACHE_TTL_S).
+    Chỉ nằm trong RAM: câu hỏi một lần không ghi vào bảng cache tài liệu.
+    """
+
+    def __init__(self):
+        self._items: "OrderedDict[Tuple[str, str], Tuple[float, np.ndarray]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, namespace: str, key: str):
+        ttl = get_float("QUERY_CACHE_TTL_S", 3600)
+        with self._lock:
+            item = self._items.get((namespace, key))
+            if item is not None and (ttl <= 0 or time.monotonic() - item[0] <= ttl):
+                self._items.move_to_end((namespace, key))
+                self.hits += 1
+                return item[1]
+            if item is not None:
+                del self._items[(namespace, key)]
+            self.misses += 1
+            return None
+
+    def put(self, namespace: str, key: str, vec: np.ndarray) -> None:
+        size = get_int("QUERY_CACHE_SIZE", 1024)
+        if size <= 0:
+            return
+        with self._lock:
+            self._items.pop((namespace, key), None)
+            self._items[(namespace, key)] = (time.monotonic(), vec)
+            while len(self._items) > size:
+                self._items.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._items.clear()
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+_pools: Dict[str, _ConnectionPool] = {}
+_pools_lock = threading.Lock()
+_memory = _MemoryLRU()
+_queries = _QueryCache()
+_stats = {"lookups": 0, "memory_hits": 0, "disk_hits": 0, "misses": 0, "evicted": 0}
+_stats_lock = threading.Lock()
+# số dòng ghi từ lần kiểm tra dung lượng gần nhất, theo db_path
+_writes_since_check: Dict[str, int] = {}
+
+def _pool(db_path: str) -> _ConnectionPool:
+    with _pools_lock:
+        pool = _pools.get(db_path)
+        if pool is None:
+            pool = _ConnectionPool(db_path, get_int("EMBED_CACHE_POOL_SIZE", 4))
+            _pools[db_path] = pool
+        return pool
+
+def _select(con: sqlite3.Connection, sql: str, keys: List[str], *params):
+    # chia nhỏ để không vượt giới hạn số tham số của SQLite
+    for lo in range(0, len(keys), 500):
+        part = keys[lo:lo + 500]
+        qmarks = ",".join("?" for _ in part)
+        yield from con.execute(sql.format(qmarks=qmarks), (*params, *part)).fetchall()
+
+def fetch_many(db_path: str, keys: Iterable[str], namespace: str = "") -> Dict[str, np.ndarray]:
+    keys = list(keys)
     if not keys:
         return {}
-    con = _connect(db_path)
-    qmarks = ",".join("?" for _ in keys)
-    cur = con.execute(f"SELECT k, dim, vec FROM embed_cache WHERE k IN ({qmarks})", list(keys))
-    out: Dict[str, np.ndarray] = {}
-    for k, dim, blob in cur.fetchall():
-        arr = np.frombuffer(blob, dtype=np.float32)
-        out[k] = arr.reshape(dim)
-    con.close()
+    out = _memory.get_many(db_path, namespace, keys)
+    rest = [k for k in keys if k not in out]
+    from_disk: Dict[str, np.ndarray] = {}
+    if rest:
+        now = int(time.time())
+        stale: List[str] = []
+        legacy: List[Tuple[str, np.ndarray]] = []
+        with _pool(db_path).connection() as con:
+            for k, dim, dtype, blob, ts in _select(
+                con,
+                "SELECT k, dim, dtype, vec, ts FROM embed_cache_v2 WHERE ns=? AND k IN ({qmarks})",
+                rest, namespace,
+            ):
+                from_disk[k] = _decode(dim, dtype, blob)
+                if now - ts > _TOUCH_EVERY_S:
+                    stale.append(k)
+            missing = [k for k in rest if k not in from_disk]
+            legacy_ns = os.getenv("LEGACY_EMBED_NAMESPACE", _LEGACY_NAMESPACE_DEFAULT)
+            if missing and namespace == legacy_ns and _has_legacy(con):
+                for k, dim, blob in _select(
+                    con, "SELECT k, dim, vec FROM embed_cache WHERE k IN ({qmarks})", missing
+                ):
+                    legacy.append((k, _decode(dim, "f4", blob)))
+                from_disk.update(legacy)
+            if stale:
+                # cập nhật "lần dùng gần nhất" (thưa, tối đa 1 lần/giờ mỗi entry) cho LRU trên disk
+                for lo in range(0, len(stale), 500):
+                    part = stale[lo:lo + 500]
+                    con.execute(
+                        f"UPDATE embed_cache_v2 SET ts=? WHERE ns=? AND k IN ({','.join('?' for _ in part)})",
+                        (now, namespace, *part),
+                    )
+                con.commit()
+        if legacy:
+            # chuyển dần entry của bảng cũ sang bảng có namespace
+            upsert_many(db_path, legacy, namespace)
+        _memory.put_many(db_path, namespace, from_disk.items())
+        out.update(from_disk)
+    with _stats_lock:
+        _stats["lookups"] += len(keys)
+        _stats["memory_hits"] += len(keys) - len(rest)
+        _stats["disk_hits"] += len(from_disk)
+        _stats["misses"] += len(rest) - len(from_disk)
     return out
 
-def upsert_many(db_path: str, items: List[Tuple[str, np.ndarray]]) -> None:
+def fetch_query(namespace: str, key: str):
+    """Embedding câu hỏi trong cache RAM (None nếu không có / hết TTL)."""
+    return _queries.get(namespace, key)
+
+def store_query(namespace: str, key: str, vec: np.ndarray) -> None:
+    _queries.put(namespace, key, vec)
+
+def upsert_many(db_path: str, items: List[Tuple[str, np.ndarray]], namespace: str = "") -> None:
     if not items:
         return
-    con = _connect(db_path)
-    cur = con.cursor()
-    cur.executemany(
-        "INSERT OR REPLACE INTO embed_cache(k, dim, vec) VALUES (?,?,?)",
-        [(k, v.shape[0], v.astype("float32").tobytes()) for k, v in items]
-    )
-    con.commit()
-    con.close()
+    items = [(k, np.asarray(v, dtype=np.float32)) for k, v in items]
+    dtype = _storage_dtype()
+    now = int(time.time())
+    with _pool(db_path).connection() as con:
+        # upsert (không dùng INSERT OR REPLACE: phần xoá ngầm của REPLACE không chạy trigger
+        # nên bộ đếm byte sẽ lệch)
+        con.executemany(
+            "INSERT INTO embed_cache_v2(ns, k, dim, dtype, vec, ts) VALUES (?,?,?,?,?,?) "
+            "ON CONFLICT(ns, k) DO UPDATE SET dim=excluded.dim, dtype=excluded.dtype, "
+            "vec=excluded.vec, ts=excluded.ts",
+            [(namespace, k, v.shape[0], dtype, v.astype(_DTYPES[dtype]).tobytes(), now) for k, v in items]
+        )
+        con.commit()
+    _memory.put_many(db_path, namespace, items)
+    with _stats_lock:
+        n = _writes_since_check.get(db_path, 0) + len(items)
+        check = n >= get_int("EMBED_CACHE_CHECK_EVERY", 1000)
+        _writes_since_check[db_path] = 0 if check else n
+    if check:
+        max_bytes = get_int("EMBED_CACHE_MAX_MB", 2048) * 1024 * 1024
+        if max_bytes > 0:
+            evict_to_size(db_path, max_bytes)
+
+def _payload_bytes(con: sqlite3.Connection) -> int:
+    row = con.execute("SELECT value FROM embed_cache_meta WHERE name = 'payload_bytes'").fetchone()
+    return int(row[0]) if row else 0
+
+def evict_to_size(db_path: str, max_bytes: int) -> int:
+    """Xoá entry dùng lâu nhất (theo ts) tới khi tổng dữ liệu vector <= max_bytes; trả về số entry đã xoá."""
+    removed = 0
+    with _pool(db_path).connection() as con:
+        total = _payload_bytes(con)
+        while total > max_bytes:
+            rows = con.execute(
+                "SELECT rowid, LENGTH(vec) FROM embed_cache_v2 ORDER BY ts LIMIT 1000"
+            ).fetchall()
+            if not rows:
+                break
+            drop: List[int] = []
+            for rowid, size in rows:
+                if total <= max_bytes:
+                    break
+                drop.append(rowid)
+                total -= size
+            con.executemany("DELETE FROM embed_cache_v2 WHERE rowid=?", [(r,) for r in drop])
+            removed += len(drop)
+        con.commit()
+    if removed:
+        with _stats_lock:
+            _stats["evicted"] += removed
+        print(f"Embed cache: đã bỏ {removed} entry cũ nhất để giữ dưới {max_bytes // (1024 * 1024)} MB")
+    return removed
+
+def compact(db_path: str, max_bytes: int = 0, keep_namespaces: List[str] | None = None,
+            drop_legacy: bool = False, to_dtype: str | None = None) -> Dict:
+    """
+    Dọn file cache: bỏ namespace không còn dùng, bỏ bảng cũ không namespace,
+    chuyển dtype (f4/f2), cắt theo dung lượng (LRU) rồi VACUUM để trả lại dung lượng đĩa.
+    """
+    before = os.path.getsize(db_path) if os.path.exists(db_path) else 0
+    report: Dict = {"db_path": db_path, "bytes_before": before}
+    with _pool(db_path).connection() as con:
+        if keep_namespaces:
+            qmarks = ",".join("?" for _ in keep_namespaces)
+            cur = con.execute(f"DELETE FROM embed_cache_v2 WHERE ns NOT IN ({qmarks})", keep_namespaces)
+            report["dropped_other_namespaces"] = cur.rowcount
+        if drop_legacy and _has_legacy(con):
+            report["dropped_legacy"] = con.execute("SELECT COUNT(*) FROM embed_cache").fetchone()[0]
+            con.execute("DROP TABLE embed_cache")
+        if to_dtype in _DTYPES:
+            rows = con.execute(
+                "SELECT rowid, dim, dtype, vec FROM embed_cache_v2 WHERE dtype<>?", (to_dtype,)
+            ).fetchall()
+            con.executemany(
+                "UPDATE embed_cache_v2 SET dtype=?, vec=? WHERE rowid=?",
+                [(to_dtype, _decode(dim, dt, blob).astype(_DTYPES[to_dtype]).tobytes(), rowid)
+                 for rowid, dim, dt, blob in rows],
+            )
+            report["converted"] = len(rows)
+        con.commit()
+    if max_bytes > 0:
+        report["evicted"] = evict_to_size(db_path, max_bytes)
+    with _pool(db_path).connection() as con:
+        con.execute("VACUUM")
+        # WAL: VACUUM chỉ ghi vào -wal, checkpoint để file chính thực sự nhỏ lại
+        con.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        report["entries"] = con.execute("SELECT COUNT(*) FROM embed_cache_v2").fetchone()[0]
+        report["namespaces"] = dict(
+            con.execute("SELECT ns, COUNT(*) FROM embed_cache_v2 GROUP BY ns").fetchall()
+        )
+    _memory.clear()
+    report["bytes_after"] = os.path.getsize(db_path) if os.path.exists(db_path) else 0
+    return report
+
+def cache_stats() -> Dict:
+    """Hit theo từng tầng (RAM / SQLite) tính trên số key tra cứu."""
+    with _stats_lock:
+        s = dict(_stats)
+    n = s["lookups"] or 1
+    s["memory_hit_rate"] = s["memory_hits"] / n
+    s["disk_hit_rate"] = s["disk_hits"] / n
+    s["memory_entries"] = len(_memory)
+    s["memory_bytes"] = _memory._bytes
+    s["query_hits"] = _queries.hits
+    s["query_misses"] = _queries.misses
+    s["query_entries"] = len(_queries)
+    return s
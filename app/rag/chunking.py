@@ -1,5 +1,11 @@
 from __future__ import annotations
+from concurrent.futures.process import BrokenProcessPool
 from typing import List, Tuple
+
+import numpy as np
+
+from app.utils import procpool
+from app.utils.config import get_int
 from app.utils.schema import Chunk
 
 # tiktoken có thể không có sẵn tokenizer "cl100k_base" trên 1 số máy rất cũ,
@@ -9,47 +15,65 @@ import tiktoken
 ENC = tiktoken.get_encoding("cl100k_base")
 
 
-def _tokens(text: str) -> list[int]:
-    return ENC.encode(text or "")
+_BREAKS = (". ", "! ", "? ", "\n\n", "\n")
 
 
-def _detokenize(ids: list[int]) -> str:
-    return ENC.decode(ids)
+def _tokens(text: str) -> list[int]:
+    return ENC.encode(text or "")
 
 
-def chunk_pages(
-    pages: List[Tuple[int, str]],
+def _token_offsets(ids: list[int]) -> Tuple[str, np.ndarray]:
+    """
+    Decode một lần → (text, offsets) với offsets[i] = vị trí ký tự bắt đầu token i
+    và offsets[n] = len(text). Token bắt đầu giữa một ký tự UTF-8 (tiếng Việt có dấu,
+    emoji) được gán về ký tự chứa nó, giống tiktoken.decode_with_offsets nhưng vector hoá.
+    """
+    parts = ENC.decode_tokens_bytes(ids)
+    raw = b"".join(parts)
+    text = raw.decode("utf-8", errors="replace")
+    lens = np.fromiter((len(p) for p in parts), dtype=np.int64, count=len(parts))
+    byte_starts = np.concatenate(([0], np.cumsum(lens)[:-1])) if len(parts) else np.zeros(0, np.int64)
+    buf = np.frombuffer(raw, dtype=np.uint8)
+    char_of_byte = np.cumsum((buf & 0xC0) != 0x80) - 1
+    offsets = np.empty(len(parts) + 1, dtype=np.int64)
+    offsets[:-1] = np.maximum(char_of_byte[byte_starts], 0) if len(parts) else 0
+    offsets[-1] = len(text)
+    return text, offsets
+
+
+def _find_break(text: str, lo: int, hi: int, far: int) -> int:
+    """
+    Vị trí ký tự ngay sau dấu ngắt câu tốt nhất: ưu tiên theo thứ tự _BREAKS, lấy dấu
+    ngắt cuối cùng trong [lo, hi); không có thì dấu ngắt đầu tiên trong [hi, far). -1 nếu không có.
+    """
+    for marker in _BREAKS:
+        pos = text.rfind(marker, lo, hi)
+        if pos == -1:
+            pos = text.find(marker, hi, far)
+        if pos != -1:
+            return pos + len(marker)
+    return -1
+
+
+def _build_chunks(
+    page_spans: List[Tuple[int, list]],
     doc_name: str,
-    chunk_size: int = 400,
-    overlap: int = 50,
     upload_timestamp: float = None,
     document_status: str = "active",
     document_version: int = 1,
 ) -> List[Chunk]:
-    """Nhận (page, text) -> trả về danh sách Chunk token-aware với semantic enhancement."""
+    """Gán chunk_id theo thứ tự (trang, vị trí trong trang) → kết quả tất định dù chia song song."""
     out: List[Chunk] = []
     cid = 0
-    for page_no, text in pages:
-        ids = _tokens(text)
-        n = len(ids)
-        if n == 0:
-            continue
-
-        # Semantic chunking: ưu tiên cắt tại các điểm logic
-        chunks = _semantic_split(text, chunk_size, overlap)
-
-        for chunk_text in chunks:
-            chunk_ids = _tokens(chunk_text)
-            if not chunk_ids:
-                continue
-
+    for page_no, spans in page_spans:
+        for start, end, start_char, end_char, chunk_text in spans:
             out.append(
                 Chunk(
                     doc_name=doc_name,
                     page=page_no,
                     chunk_id=cid,
                     text=chunk_text,
-                    n_tokens=len(chunk_ids),
+                    n_tokens=end - start,
                     upload_timestamp=upload_timestamp,
                     document_status=document_status,
                     document_version=document_version,
@@ -57,8 +81,10 @@ def chunk_pages(
                         "doc": doc_name,
                         "filename": doc_name,  # ✅ FIX: Thêm filename để citation hiển thị đúng
                         "page": page_no,
-                        "start_token": 0,  # Có thể cải tiến sau
-                        "end_token": len(chunk_ids),
+                        "start_token": start,
+                        "end_token": end,
+                        "start_char": start_char,
+                        "end_char": end_char,
                         "semantic_chunk": True,
                         "upload_timestamp": upload_timestamp,
                         "document_status": document_status,
@@ -70,51 +96,123 @@ def chunk_pages(
     return out
 
 
-def _semantic_split(text: str, chunk_size: int, overlap: int) -> List[str]:
-    """Chia text thành chunks với semantic awareness."""
+def chunk_pages(
+    pages: List[Tuple[int, str]],
+    doc_name: str,
+    chunk_size: int = 400,
+    overlap: int = 50,
+    upload_timestamp: float = None,
+    document_status: str = "active",
+    document_version: int = 1,
+) -> List[Chunk]:
+    """Nhận (page, text) -> trả về danh sách Chunk token-aware với semantic enhancement."""
+    doc = {
+        "doc_name": doc_name,
+        "upload_timestamp": upload_timestamp,
+        "document_status": document_status,
+        "document_version": document_version,
+    }
+    return chunk_documents([(pages, doc)], chunk_size=chunk_size, overlap=overlap)[0]
+
+
+def chunk_documents(
+    docs: List[Tuple[List[Tuple[int, str]], dict]],
+    chunk_size: int = 400,
+    overlap: int = 50,
+) -> List[List[Chunk]]:
+    """
+    Chunk nhiều tài liệu một lượt. docs = [(pages, {doc_name, upload_timestamp,
+    document_status, document_version})] → danh sách Chunk theo đúng thứ tự docs.
+    Khi tổng text đủ lớn (CHUNK_PARALLEL_MIN_CHARS), các nhóm trang của mọi tài liệu
+    được tokenize/chia trên process pool dùng chung (PROCESS_POOL_WORKERS); chunk_id
+    vẫn đánh theo thứ tự trang.
+    """
+    items = [
+        (d, page_no, text)
+        for d, (pages, _) in enumerate(docs)
+        for page_no, text in pages
+        if text
+    ]
+    total_chars = sum(len(text) for _, _, text in items)
+    spans = None
+    min_chars = get_int("CHUNK_PARALLEL_MIN_CHARS", 200_000)
+    if total_chars >= min_chars and procpool.n_workers() > 1:
+        spans = _parallel_spans(items, total_chars, chunk_size, overlap)
+    if spans is None:
+        spans = _spans_task([text for _, _, text in items], chunk_size, overlap)
+
+    per_doc: List[List[Tuple[int, list]]] = [[] for _ in docs]
+    for (d, page_no, _), page_spans in zip(items, spans):
+        per_doc[d].append((page_no, page_spans))
+    return [_build_chunks(page_spans, **meta) for page_spans, (_, meta) in zip(per_doc, docs)]
+
+
+def _spans_task(texts: List[str], chunk_size: int, overlap: int) -> List[list]:
+    """Đơn vị công việc cho process pool: chia một nhóm trang."""
+    return [_semantic_spans(text, chunk_size, overlap) for text in texts]
+
+
+def _parallel_spans(items: list, total_chars: int, chunk_size: int, overlap: int):
+    """Gom trang liên tiếp thành nhóm ~đều ký tự (≈4 nhóm/worker) rồi map trên pool; None nếu pool lỗi."""
+    target = max(20_000, total_chars // (procpool.n_workers() * 4))
+    groups: List[List[str]] = [[]]
+    size = 0
+    for _, _, text in items:
+        if groups[-1] and size + len(text) > target:
+            groups.append([])
+            size = 0
+        groups[-1].append(text)
+        size += len(text)
+    try:
+        pool = procpool.get_pool()
+        results = pool.map(_spans_task, groups, [chunk_size] * len(groups), [overlap] * len(groups))
+        return [page_spans for group in results for page_spans in group]
+    except BrokenProcessPool as e:
+        print(f"Chunking song song lỗi ({e}); chạy tuần tự")
+        procpool.discard(pool)
+        return None
+
+
+def _semantic_spans(
+    text: str, chunk_size: int, overlap: int
+) -> List[Tuple[int, int, int, int, str]]:
+    """
+    Chia text thành chunks với semantic awareness, một lượt duy nhất.
+    Trả về (start_token, end_token, start_char, end_char, chunk_text); dấu ngắt câu
+    được tìm trên text gốc rồi ánh xạ về token qua bảng offsets.
+    """
     ids = _tokens(text)
     n = len(ids)
+    if n == 0:
+        return []
+    text, offsets = _token_offsets(ids)
 
     if n <= chunk_size:
-        return [_detokenize(ids)]
+        return [(0, n, 0, len(text), text)]
 
-    chunks = []
+    spans = []
     start = 0
+    min_len = int(chunk_size * 0.7)
 
     while start < n:
-        # Tìm điểm kết thúc semantic
         end = min(start + chunk_size, n)
 
-        # Ưu tiên cắt tại câu hoàn chỉnh
+        # Ưu tiên cắt tại câu hoàn chỉnh: dấu ngắt sau 70% chunk_size, chấp nhận vượt tối đa 50 token
         if end < n:
-            # Tìm dấu chấm, chấm hỏi, chấm than gần nhất
-            search_end = min(end + 50, n)  # Tìm trong phạm vi rộng hơn
-            text_segment = _detokenize(ids[start:search_end])
-
-            # Tìm vị trí cắt semantic
-            semantic_breaks = [". ", "! ", "? ", "\n\n", "\n"]
-            best_break = end
-
-            for break_marker in semantic_breaks:
-                pos = text_segment.find(break_marker)
-                if pos != -1:
-                    token_pos = start + len(
-                        _tokens(text_segment[: pos + len(break_marker)])
-                    )
-                    if token_pos > start + chunk_size * 0.7 and token_pos < search_end:
-                        best_break = token_pos
-                        break
-
-            end = min(best_break, n)
-
-        # Tạo chunk
-        chunk_ids = ids[start:end]
-        chunk_text = _detokenize(chunk_ids)
-        chunks.append(chunk_text)
+            far = min(end + 50, n)
+            lo = int(offsets[min(start + min_len + 1, n)])
+            pos = _find_break(text, lo, int(offsets[end]), int(offsets[far]))
+            if pos != -1:
+                brk = int(np.searchsorted(offsets, pos, side="left"))
+                if start + min_len < brk < far:
+                    end = brk
+
+        start_char, end_char = int(offsets[start]), int(offsets[end])
+        spans.append((start, end, start_char, end_char, text[start_char:end_char]))
 
         # Tính overlap
         if end == n:
             break
         start = max(0, end - overlap)
 
-    return chunks
+    return spans
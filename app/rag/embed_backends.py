@@ -0,0 +1,174 @@
+from __future__ import annotations
+import hashlib, os, threading
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from app.utils.config import get_int, get_float
+from app.rag.bm25_index import _tokenize
+
+# Backend embedding cắm được phía sau embed_texts / embed_query.
+# EMBED_BACKEND=gemini (mặc định) | local (sentence-transformers, CPU) | hash (tất định, không cần mạng)
+
+TASK_DOCUMENT = "retrieval_document"
+TASK_QUERY = "retrieval_query"
+
+class EmbeddingBackend:
+    """
+    Giao diện backend: embed(texts, task) → (n, D) float32 (chưa cần L2-norm).
+    - name: định danh không gian vector (dùng làm namespace cache)
+    - remote: True → gọi qua embed_client (pool dùng chung + AIMD + retry)
+    - max_batch / max_batch_chars: giới hạn kích thước mỗi lần gọi embed
+    """
+    name = "base"
+    remote = False
+    max_batch = 100
+    max_batch_chars = 60000
+
+    def embed(self, texts: List[str], task: str = TASK_DOCUMENT) -> np.ndarray:
+        raise NotImplementedError
+
+class GeminiBackend(EmbeddingBackend):
+    remote = True
+
+    def __init__(self, model: str):
+        self.model = model
+        self.name = f"gemini:{model}"
+        self.max_batch = min(100, max(1, get_int("EMBED_BATCH_SIZE", 100)))
+        self.max_batch_chars = max(1, get_int("EMBED_BATCH_MAX_CHARS", 60000))
+        # timeout mỗi request: một call treo không giữ cả batch ingest
+        self.timeout_s = get_float("EMBED_TIMEOUT_S", 30.0)
+        self._configured = False
+
+    def _genai(self):
+        import google.generativeai as genai
+        if not self._configured:
+            api_key = os.getenv("GEMINI_API_KEY")
+            if not api_key:
+                raise RuntimeError("Missing GEMINI_API_KEY")
+            genai.configure(api_key=api_key)
+            self._configured = True
+        return genai
+
+    @staticmethod
+    def _response_embedding(r):
+        v = None
+        if isinstance(r, dict):
+            v = r.get("embedding") or r.get("values")
+        if v is None and hasattr(r, "embedding"):
+            v = r.embedding
+        if v is None:
+            raise RuntimeError(f"Unexpected embedding response: {type(r)} -> {r}")
+        return v
+
+    def _request(self, content, task: str):
+        kwargs = {}
+        if self.timeout_s > 0:
+            kwargs["request_options"] = {"timeout": self.timeout_s}
+        return self._genai().embed_content(model=self.model, content=content, task_type=task, **kwargs)
+
+    def _embed_single(self, text: str, task: str) -> np.ndarray:
+        r = self._request(text, task)
+        return np.array(self._response_embedding(r), dtype=np.float32)
+
+    def _embed_batch(self, texts: List[str], task: str) -> np.ndarray:
+        """Một request batchEmbedContents cho nhiều text → (n, D)."""
+        r = self._request(list(texts), task)
+        v = np.array(self._response_embedding(r), dtype=np.float32)
+        if v.ndim != 2 or v.shape[0] != len(texts):
+            raise RuntimeError(f"Batch embedding trả về shape {v.shape} cho {len(texts)} texts")
+        return v
+
+    def embed(self, texts: List[str], task: str = TASK_DOCUMENT) -> np.ndarray:
+        """Một request cho cả batch; retry / chia đôi batch lỗi do embed_client.call_batch lo."""
+        if len(texts) == 1:
+            return self._embed_single(texts[0], task)[None, :]
+        return self._embed_batch(texts, task)
+
+class LocalBackend(EmbeddingBackend):
+    """
+    sentence-transformers chạy CPU (LOCAL_EMBED_MODEL, mặc định multilingual-e5-base, 768 chiều).
+    encode() tự sắp text theo độ dài nên mỗi batch pad tới độ dài gần nhau;
+    torch dùng LOCAL_EMBED_THREADS (mặc định toàn bộ core).
+    """
+
+    def __init__(self, model: str):
+        self.model_name = model
+        self.name = f"local:{model}"
+        self.batch_size = max(1, get_int("LOCAL_EMBED_BATCH", 32))
+        # gom nhiều batch encode trong một lần gọi để tận dụng sắp xếp theo độ dài
+        self.max_batch = self.batch_size * 16
+        self.max_batch_chars = 10 ** 9
+        is_e5 = "e5" in model.lower()
+        self.prefixes = {
+            TASK_DOCUMENT: os.getenv("LOCAL_EMBED_DOC_PREFIX", "passage: " if is_e5 else ""),
+            TASK_QUERY: os.getenv("LOCAL_EMBED_QUERY_PREFIX", "query: " if is_e5 else ""),
+        }
+        self._model = None
+        self._load_lock = threading.Lock()
+
+    def _load(self):
+        with self._load_lock:
+            if self._model is None:
+                import torch
+                from sentence_transformers import SentenceTransformer
+                torch.set_num_threads(max(1, get_int("LOCAL_EMBED_THREADS", os.cpu_count() or 1)))
+                self._model = SentenceTransformer(self.model_name, device="cpu")
+        return self._model
+
+    def embed(self, texts: List[str], task: str = TASK_DOCUMENT) -> np.ndarray:
+        model = self._load()
+        prefix = self.prefixes.get(task, "")
+        v = model.encode(
+            [prefix + t for t in texts],
+            batch_size=self.batch_size,
+            convert_to_numpy=True,
+            show_progress_bar=False,
+        )
+        return np.asarray(v, dtype=np.float32)
+
+class HashBackend(EmbeddingBackend):
+    """
+    Embedding tất định không cần model/mạng: feature hashing unigram + bigram
+    (có dấu) vào D chiều. Dùng cho benchmark và môi trường không có mạng.
+    """
+
+    def __init__(self, dim: int):
+        self.dim = dim
+        self.name = f"hash:{dim}"
+        self.max_batch = 1024
+        self.max_batch_chars = 10 ** 9
+
+    def _features(self, text: str):
+        toks = _tokenize(text)
+        return toks + [a + " " + b for a, b in zip(toks, toks[1:])]
+
+    def embed(self, texts: List[str], task: str = TASK_DOCUMENT) -> np.ndarray:
+        out = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for f in self._features(text):
+                h = int.from_bytes(hashlib.blake2b(f.encode("utf-8"), digest_size=8).digest(), "little")
+                out[row, h % self.dim] += 1.0 if (h >> 63) & 1 else -1.0
+            if not out[row].any():
+                out[row, 0] = 1.0  # text rỗng: tránh vector 0
+        return out
+
+_backends: Dict[str, EmbeddingBackend] = {}
+_lock = threading.Lock()
+
+def get_backend(kind: Optional[str] = None) -> EmbeddingBackend:
+    """Backend theo EMBED_BACKEND (khởi tạo lazy, dùng chung cho cả process)."""
+    kind = (kind or os.getenv("EMBED_BACKEND", "gemini")).strip().lower()
+    with _lock:
+        backend = _backends.get(kind)
+        if backend is None:
+            if kind == "local":
+                backend = LocalBackend(os.getenv("LOCAL_EMBED_MODEL", "intfloat/multilingual-e5-base"))
+            elif kind == "hash":
+                backend = HashBackend(get_int("EMBED_DIM", 768))
+            else:
+                if kind != "gemini":
+                    print(f"EMBED_BACKEND không hợp lệ: {kind}; dùng gemini")
+                backend = GeminiBackend(os.getenv("RAG_EMBED_MODEL", "text-embedding-004"))
+            _backends[kind] = backend
+        return backend
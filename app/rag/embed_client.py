@@ -0,0 +1,312 @@
+from __future__ import annotations
+import asyncio, random, threading, time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, Optional
+
+import numpy as np
+
+from app.utils.config import get_int, get_float
+
+# Client gọi API embedding dùng chung cho cả process:
+# - một worker pool duy nhất (không tạo ThreadPoolExecutor mới mỗi lần gọi), cộng một
+#   pool nhỏ riêng cho câu hỏi để /ask không xếp hàng sau các batch ingest
+# - số request song song điều chỉnh kiểu AIMD: tăng dần khi thành công,
+#   giảm một nửa khi gặp rate limit (429 / quota), retry có jitter
+# - lỗi tạm thời (timeout, 5xx, mất kết nối) retry với backoff luỹ thừa;
+#   batch lỗi dai dẳng được chia đôi để cô lập input hỏng
+# - circuit breaker: provider lỗi liên tục → fail nhanh trong EMBED_BREAKER_COOLDOWN_S
+
+class EmbeddingUnavailable(RuntimeError):
+    """Circuit breaker đang mở: provider embedding được coi là không khả dụng."""
+
+class EmbeddingFailed(RuntimeError):
+    """Một số text không embed được; `errors` = {index trong danh sách gốc: exception}."""
+
+    def __init__(self, errors: Dict[int, BaseException]):
+        i, e = next(iter(errors.items()))
+        super().__init__(f"{len(errors)} text không embed được (vd. #{i}: {type(e).__name__}: {e})")
+        self.errors = errors
+
+class BatchResult:
+    """Kết quả call_batch: `vectors` {index: (D,)} của item thành công, `errors` {index: exception} của item lỗi."""
+
+    def __init__(self, vectors: Optional[Dict[int, np.ndarray]] = None,
+                 errors: Optional[Dict[int, BaseException]] = None):
+        self.vectors = vectors if vectors is not None else {}
+        self.errors = errors if errors is not None else {}
+
+def raise_errors(errors: Dict[int, BaseException]) -> None:
+    """Raise cho các index lỗi: EmbeddingUnavailable nếu breaker đã mở (route trả 503), ngược lại EmbeddingFailed."""
+    if not errors:
+        return
+    for e in errors.values():
+        if isinstance(e, EmbeddingUnavailable):
+            raise e
+    raise EmbeddingFailed(errors) from next(iter(errors.values()))
+
+def is_rate_limited(e: BaseException) -> bool:
+    name = type(e).__name__
+    if name in ("ResourceExhausted", "TooManyRequests"):
+        return True
+    if getattr(e, "code", None) == 429 or getattr(e, "status_code", None) == 429:
+        return True
+    msg = str(e).lower()
+    return "429" in msg or "quota" in msg or "rate limit" in msg or "resource exhausted" in msg
+
+def is_transient(e: BaseException) -> bool:
+    """Lỗi phía provider/mạng đáng retry (không tính rate limit, xử lý riêng bằng AIMD)."""
+    if isinstance(e, (TimeoutError, ConnectionError)):
+        return True
+    name = type(e).__name__
+    if name in ("DeadlineExceeded", "ServiceUnavailable", "InternalServerError",
+                "ServerError", "GatewayTimeout", "Timeout", "ReadTimeout", "ConnectTimeout"):
+        return True
+    code = getattr(e, "code", None) or getattr(e, "status_code", None)
+    if isinstance(code, int) and 500 <= code < 600:
+        return True
+    msg = str(e).lower()
+    return ("timed out" in msg or "timeout" in msg or "deadline" in msg
+            or "503" in msg or "unavailable" in msg or "connection" in msg)
+
+class AIMDLimiter:
+    """
+    Giới hạn số request đang chạy với ngưỡng thích nghi.
+    - thành công: limit += 1/limit (≈ +1 sau mỗi "cửa sổ" request)
+    - rate limit: limit = max(min, limit * decrease), tối đa một lần mỗi cooldown
+    - acquire(priority=True) (câu hỏi) được cấp slot trước các request thường đang chờ
+    Dùng threading.Condition nên dùng chung được cho cả đường sync lẫn async.
+    """
+
+    def __init__(self, initial: int, minimum: int, maximum: int,
+                 decrease: float = 0.5, cooldown_s: float = 1.0):
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.limit = float(min(max(initial, self.minimum), self.maximum))
+        self.decrease = decrease
+        self.cooldown_s = cooldown_s
+        self.in_flight = 0
+        self.priority_waiting = 0
+        self.successes = 0
+        self.throttled = 0
+        self._last_decrease = 0.0
+        self._cond = threading.Condition()
+
+    def acquire(self, priority: bool = False) -> None:
+        with self._cond:
+            if priority:
+                self.priority_waiting += 1
+                try:
+                    while self.in_flight >= int(self.limit):
+                        self._cond.wait()
+                finally:
+                    self.priority_waiting -= 1
+                    self._cond.notify_all()
+            else:
+                while self.in_flight >= int(self.limit) or self.priority_waiting:
+                    self._cond.wait()
+            self.in_flight += 1
+
+    def release(self, ok: bool, throttled: bool = False) -> None:
+        with self._cond:
+            self.in_flight -= 1
+            if throttled:
+                self.throttled += 1
+                now = time.monotonic()
+                if now - self._last_decrease >= self.cooldown_s:
+                    self.limit = max(float(self.minimum), self.limit * self.decrease)
+                    self._last_decrease = now
+            elif ok:
+                self.successes += 1
+                self.limit = min(float(self.maximum), self.limit + 1.0 / self.limit)
+            self._cond.notify_all()
+
+    def stats(self) -> Dict:
+        return {
+            "limit": round(self.limit, 2),
+            "in_flight": self.in_flight,
+            "successes": self.successes,
+            "throttled": self.throttled,
+        }
+
+class CircuitBreaker:
+    """
+    closed → (EMBED_BREAKER_THRESHOLD lỗi tạm thời liên tiếp) → open: mọi call fail ngay
+    → sau EMBED_BREAKER_COOLDOWN_S cho một request thử (half-open): thành công → closed,
+    lỗi → open lại. Rate limit (429) không tính là thành công hay lỗi: trạng thái giữ nguyên.
+    """
+
+    def __init__(self, threshold: int, cooldown_s: float):
+        self.threshold = max(1, threshold)
+        self.cooldown_s = cooldown_s
+        self.failures = 0
+        self.opened_at = 0.0
+        self.state = "closed"
+        self.rejected = 0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def before_call(self) -> None:
+        with self._lock:
+            if self.state == "closed":
+                return
+            if self.state == "open" and time.monotonic() - self.opened_at >= self.cooldown_s:
+                self.state = "half_open"
+            if self.state == "half_open" and not self._probing:
+                self._probing = True
+                return
+            self.rejected += 1
+        raise EmbeddingUnavailable("Dịch vụ embedding tạm thời không khả dụng (circuit breaker đang mở)")
+
+    def record(self, ok: Optional[bool]) -> None:
+        """ok=None: kết quả không nói gì về sức khoẻ provider (rate limit), chỉ nhả lượt thử half-open."""
+        with self._lock:
+            self._probing = False
+            if ok is None:
+                return
+            if ok:
+                self.failures = 0
+                self.state = "closed"
+                return
+            self.failures += 1
+            if self.state == "half_open" or self.failures >= self.threshold:
+                if self.state != "open":
+                    print(f"Embedding: mở circuit breaker sau {self.failures} lỗi liên tiếp")
+                self.state = "open"
+                self.opened_at = time.monotonic()
+
+    def stats(self) -> Dict:
+        return {"state": self.state, "consecutive_failures": self.failures, "rejected": self.rejected}
+
+_lock = threading.Lock()
+_executor: Optional[ThreadPoolExecutor] = None
+_query_executor: Optional[ThreadPoolExecutor] = None
+_limiter: Optional[AIMDLimiter] = None
+_breaker: Optional[CircuitBreaker] = None
+
+def limiter() -> AIMDLimiter:
+    global _limiter
+    with _lock:
+        if _limiter is None:
+            _limiter = AIMDLimiter(
+                initial=get_int("EMBED_CONCURRENCY", 4),
+                minimum=get_int("EMBED_MIN_CONCURRENCY", 1),
+                maximum=get_int("EMBED_MAX_CONCURRENCY", 16),
+            )
+        return _limiter
+
+def breaker() -> CircuitBreaker:
+    global _breaker
+    with _lock:
+        if _breaker is None:
+            _breaker = CircuitBreaker(
+                threshold=get_int("EMBED_BREAKER_THRESHOLD", 5),
+                cooldown_s=get_float("EMBED_BREAKER_COOLDOWN_S", 30.0),
+            )
+        return _breaker
+
+def executor() -> ThreadPoolExecutor:
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=max(1, get_int("EMBED_MAX_CONCURRENCY", 16)),
+                thread_name_prefix="embed",
+            )
+        return _executor
+
+def query_executor() -> ThreadPoolExecutor:
+    """Pool nhỏ (EMBED_QUERY_WORKERS) cho batch câu hỏi, tách khỏi hàng đợi FIFO của executor()."""
+    global _query_executor
+    with _lock:
+        if _query_executor is None:
+            _query_executor = ThreadPoolExecutor(
+                max_workers=max(1, get_int("EMBED_QUERY_WORKERS", 4)),
+                thread_name_prefix="embed-query",
+            )
+        return _query_executor
+
+def call(fn: Callable, *args, priority: bool = False):
+    """
+    Gọi `fn(*args)` trong giới hạn AIMD (priority=True: câu hỏi, được cấp slot trước).
+    - rate limit → giảm limit, chờ (jitter) rồi thử lại (EMBED_RATE_LIMIT_RETRIES)
+    - lỗi tạm thời → backoff luỹ thừa có jitter (EMBED_RETRIES), tính vào circuit breaker
+    - lỗi khác (input hỏng, 4xx) → raise ngay
+    """
+    lim = limiter()
+    brk = breaker()
+    rl_retries = max(0, get_int("EMBED_RATE_LIMIT_RETRIES", 5))
+    retries = max(0, get_int("EMBED_RETRIES", 3))
+    base = get_float("EMBED_BACKOFF_BASE_S", 0.5)
+    rl_attempt = attempt = 0
+    while True:
+        brk.before_call()
+        lim.acquire(priority)
+        try:
+            out = fn(*args)
+        except Exception as e:
+            throttled = is_rate_limited(e)
+            lim.release(ok=False, throttled=throttled)
+            if throttled:
+                brk.record(ok=None)  # provider đang đẩy lùi: không đóng/không reset breaker; AIMD lo giảm tải
+                if rl_attempt >= rl_retries:
+                    raise
+                delay = min(30.0, base * (2 ** rl_attempt)) * random.uniform(0.5, 1.5)
+                rl_attempt += 1
+                print(f"Embedding bị rate limit, thử lại sau {delay:.2f}s (limit={lim.limit:.1f})")
+            elif is_transient(e):
+                brk.record(ok=False)
+                if attempt >= retries:
+                    raise
+                delay = min(30.0, base * (2 ** attempt)) * random.uniform(0.5, 1.5)
+                attempt += 1
+                print(f"Embedding lỗi tạm thời ({type(e).__name__}: {e}), thử lại sau {delay:.2f}s")
+            else:
+                brk.record(ok=True)
+                raise
+            time.sleep(delay)
+            continue
+        lim.release(ok=True)
+        brk.record(ok=True)
+        return out
+
+def call_batch(fn: Callable, items: list, *args, priority: bool = False) -> BatchResult:
+    """
+    `call(fn, items, *args)` → BatchResult. Nếu cả batch vẫn lỗi (không phải rate limit /
+    lỗi tạm thời / circuit breaker) thì chia đôi và gọi từng nửa, tới khi cô lập được item gây lỗi;
+    vector của các phần thành công vẫn được trả về (caller ghi cache), chỉ các index
+    lỗi nằm trong `errors`.
+    """
+    out = BatchResult()
+    _call_split(fn, items, 0, out, args, priority)
+    return out
+
+def _call_split(fn: Callable, items: list, lo: int, out: BatchResult, args: tuple, priority: bool) -> None:
+    try:
+        vecs = call(fn, items, *args, priority=priority)
+    except Exception as e:
+        # rate limit / breaker / lỗi tạm thời đã hết retry: lỗi của provider, không phải của
+        # input → chia đôi chỉ nhân số request lên provider đang gặp sự cố
+        if (len(items) <= 1 or is_rate_limited(e) or is_transient(e)
+                or isinstance(e, EmbeddingUnavailable)):
+            out.errors.update((lo + i, e) for i in range(len(items)))
+            return
+        mid = len(items) // 2
+        print(f"Embedding batch {len(items)} lỗi ({type(e).__name__}: {e}); chia đôi {mid}+{len(items) - mid}")
+        _call_split(fn, items[:mid], lo, out, args, priority)
+        _call_split(fn, items[mid:], lo + mid, out, args, priority)
+        return
+    out.vectors.update((lo + i, vec) for i, vec in enumerate(vecs))
+
+def submit_batch(fn: Callable, items: list, *args) -> Future:
+    """Chạy `call_batch(fn, items, *args)` trên worker pool dùng chung (đường sync)."""
+    return executor().submit(call_batch, fn, items, *args)
+
+async def run_batch(fn: Callable, items: list, *args) -> BatchResult:
+    """Phiên bản async của submit_batch: không chặn event loop trong lúc chờ API."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor(), call_batch, fn, items, *args)
+
+def stats() -> Dict:
+    s = limiter().stats()
+    s["breaker"] = breaker().stats()
+    return s
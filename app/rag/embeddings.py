@@ -1,93 +1,282 @@
 from __future__ import annotations
-import os, time
-from typing import List, Dict
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import asyncio, os, threading, time
+from concurrent.futures import Future
+from queue import Empty, Queue
+from typing import List, Dict, Tuple
 
 import numpy as np
-import google.generativeai as genai
 
 from app.utils.hash import sha1_text
-from app.rag.cache import fetch_many, upsert_many
-
-EMBED_MODEL = os.getenv("RAG_EMBED_MODEL", "text-embedding-004")
-
-def _ensure_init():
-    api_key = os.getenv("GEMINI_API_KEY")
-    if not api_key:
-        raise RuntimeError("Missing GEMINI_API_KEY")
-    genai.configure(api_key=api_key)
+from app.utils.config import get_int, get_float
+from app.rag.cache import fetch_many, upsert_many, fetch_query, store_query
+from app.rag import embed_client
+from app.rag.embed_backends import TASK_DOCUMENT, TASK_QUERY, EmbeddingBackend, get_backend
 
 def _l2_normalize(x: np.ndarray) -> np.ndarray:
     n = np.linalg.norm(x, axis=1, keepdims=True) + 1e-12
     return (x / n).astype("float32")
 
-def _embed_single(text: str) -> np.ndarray:
-    r = genai.embed_content(model=EMBED_MODEL, content=text, task_type="retrieval_document")
-    v = None
-    if isinstance(r, dict):
-        v = r.get("embedding") or r.get("values")
-    if v is None and hasattr(r, "embedding"):
-        v = r.embedding
-    if v is None:
-        raise RuntimeError(f"Unexpected embedding response: {type(r)} -> {r}")
-    return np.array(v, dtype=np.float32)
+def _cache_namespace(backend: EmbeddingBackend, task: str = TASK_DOCUMENT) -> str:
+    # vector của model/task khác nhau nằm ở namespace khác nhau trong cache
+    return f"{backend.name}|{task}"
 
-def embed_texts(texts: List[str]) -> np.ndarray:
+def _split_batches(indices: List[int], texts: List[str], backend: EmbeddingBackend) -> List[List[int]]:
     """
-    Trả về (N, D) embeddings (L2-normalized).
-    Sử dụng cache SQLite theo SHA1(text) + gọi Gemini song song cho các miss.
+    Chia các index cần embed thành batch theo số lượng (backend.max_batch; Gemini: EMBED_BATCH_SIZE, tối đa 100)
+    và tổng kích thước request (backend.max_batch_chars; Gemini: EMBED_BATCH_MAX_CHARS, ~4 ký tự/token).
     """
-    _ensure_init()
+    max_items, max_chars = backend.max_batch, backend.max_batch_chars
+    batches: List[List[int]] = []
+    cur: List[int] = []
+    cur_chars = 0
+    for i in indices:
+        n_chars = len(texts[i])
+        if cur and (len(cur) >= max_items or cur_chars + n_chars > max_chars):
+            batches.append(cur)
+            cur, cur_chars = [], 0
+        cur.append(i)
+        cur_chars += n_chars
+    if cur:
+        batches.append(cur)
+    return batches
 
-    if not texts:
-        return np.zeros((0, 768), dtype=np.float32)
-
-    # 1) Tính key SHA1
+def _lookup(texts: List[str], backend: EmbeddingBackend):
+    """Key SHA1(text) + hit cache (theo namespace backend/task); trả về (keys, cached, miss_indices, db_path)."""
     keys = [sha1_text(t) for t in texts]
-
-    # 2) Hit cache
     db_path = os.getenv("EMBED_CACHE_DB", "./storage/embed_cache.sqlite")
-    cached: Dict[str, np.ndarray] = fetch_many(db_path, keys)
-
-    # 3) Chuẩn bị indices cho miss
+    cached: Dict[str, np.ndarray] = fetch_many(db_path, keys, _cache_namespace(backend))
     miss_indices = [i for i, k in enumerate(keys) if k not in cached]
-    hits = len(keys) - len(miss_indices)
-
-    # 4) Gọi song song cho miss
-    conc = max(1, int(os.getenv("EMBED_CONCURRENCY", "4")))
-    sleep_ms = max(0, int(os.getenv("EMBED_SLEEP_MS", "0")))
-    results: Dict[int, np.ndarray] = {}
+    return keys, cached, miss_indices, db_path
 
-    if miss_indices:
-        with ThreadPoolExecutor(max_workers=conc) as ex:
-            fut2idx = {
-                ex.submit(_embed_single, texts[i]): i
-                for i in miss_indices
-            }
-            for fut in as_completed(fut2idx):
-                i = fut2idx[fut]
-                vec = fut.result()
-                results[i] = vec
-                if sleep_ms:
-                    time.sleep(sleep_ms / 1000.0)
-
-        # 5) Ghi cache cho miss
-        upsert_many(
-            db_path,
-            [(keys[i], results[i]) for i in miss_indices]
-        )
-
-    # 6) Lắp mảng theo thứ tự gốc
+def _assemble(keys: List[str], cached: Dict[str, np.ndarray], results: Dict[int, np.ndarray]) -> np.ndarray:
+    """Lắp mảng theo thứ tự gốc rồi L2-normalize."""
     dim = (next(iter(cached.values())).shape[0]
            if cached else (next(iter(results.values())).shape[0] if results else 768))
-    out = np.zeros((len(texts), dim), dtype=np.float32)
+    out = np.zeros((len(keys), dim), dtype=np.float32)
     for i, k in enumerate(keys):
         if k in cached:
             out[i] = cached[k]
         else:
             out[i] = results[i]
-
     return _l2_normalize(out)
 
+def _store_batch(db_path: str, backend: EmbeddingBackend, keys: List[str], batch: List[int],
+                 res: embed_client.BatchResult, results: Dict[int, np.ndarray]) -> Dict[int, BaseException]:
+    """Ghi cache các item thành công của batch; trả về lỗi theo index gốc của các item hỏng."""
+    done = [batch[j] for j in sorted(res.vectors)]
+    for j, vec in res.vectors.items():
+        results[batch[j]] = vec
+    if done:
+        upsert_many(db_path, [(keys[i], results[i]) for i in done], _cache_namespace(backend))
+    return {batch[j]: e for j, e in res.errors.items()}
+
+def _local_batch(backend: EmbeddingBackend, texts: List[str]) -> embed_client.BatchResult:
+    return embed_client.BatchResult(dict(enumerate(backend.embed(texts))))
+
+def embed_texts(texts: List[str]) -> np.ndarray:
+    """
+    Trả về (N, D) embeddings (L2-normalized) theo backend EMBED_BACKEND.
+    Sử dụng cache SQLite + gọi backend theo batch cho các miss; backend remote (Gemini)
+    đi qua worker pool dùng chung của embed_client (concurrency AIMD).
+    Trong route async dùng aembed_texts để không chặn event loop.
+    """
+    if not texts:
+        return np.zeros((0, 768), dtype=np.float32)
+
+    backend = get_backend()
+    keys, cached, miss_indices, db_path = _lookup(texts, backend)
+    results: Dict[int, np.ndarray] = {}
+    errors: Dict[int, BaseException] = {}
+
+    if miss_indices:
+        batches = _split_batches(miss_indices, texts, backend)
+        if backend.remote:
+            futs = [
+                embed_client.submit_batch(backend.embed, [texts[i] for i in batch])
+                for batch in batches
+            ]
+            outs = (fut.result() for fut in futs)
+        else:
+            outs = (_local_batch(backend, [texts[i] for i in batch]) for batch in batches)
+        for batch, res in zip(batches, outs):
+            # ghi cache ngay từng batch (kể cả phần thành công của batch có item lỗi)
+            errors.update(_store_batch(db_path, backend, keys, batch, res, results))
+    # chỉ raise cho các text lỗi, sau khi phần đã embed nằm trong cache
+    embed_client.raise_errors(errors)
+
+    return _assemble(keys, cached, results)
+
+async def aembed_texts(texts: List[str]) -> np.ndarray:
+    """Phiên bản async của embed_texts: cache SQLite và backend đều chạy ngoài event loop."""
+    if not texts:
+        return np.zeros((0, 768), dtype=np.float32)
+
+    backend = get_backend()
+    keys, cached, miss_indices, db_path = await asyncio.to_thread(_lookup, texts, backend)
+    results: Dict[int, np.ndarray] = {}
+    errors: Dict[int, BaseException] = {}
+
+    if miss_indices:
+        batches = _split_batches(miss_indices, texts, backend)
+        if backend.remote:
+            async def one(batch: List[int]) -> None:
+                res = await embed_client.run_batch(backend.embed, [texts[i] for i in batch])
+                errors.update(await asyncio.to_thread(_store_batch, db_path, backend, keys, batch, res, results))
+            await asyncio.gather(*[one(batch) for batch in batches])
+        else:
+            # backend CPU: chạy tuần tự trong một thread (model tự dùng nhiều core)
+            await asyncio.to_thread(lambda: [
+                _store_batch(db_path, backend, keys, batch, _local_batch(backend, [texts[i] for i in batch]), results)
+                for batch in batches
+            ])
+    embed_client.raise_errors(errors)
+
+    return _assemble(keys, cached, results)
+
+# Đường embedding câu hỏi: task_type=retrieval_query, cache LRU+TTL riêng trong RAM
+# (không ghi vào cache tài liệu), gộp request: các câu hỏi giống nhau đang chờ cùng lúc
+# dùng chung một Future, và micro-batching: các câu hỏi khác nhau đến trong vài ms
+# được embed bằng một lần gọi backend.
+_inflight: Dict[Tuple[str, str], Future] = {}
+_inflight_lock = threading.Lock()
+
+def _join_or_lead(key: Tuple[str, str]) -> Tuple[Future, bool]:
+    """Trả về (future, leader); leader=True → caller phải đưa câu hỏi vào batcher."""
+    with _inflight_lock:
+        fut = _inflight.get(key)
+        if fut is not None:
+            return fut, False
+        fut = Future()
+        _inflight[key] = fut
+        return fut, True
+
+def _settle(key: Tuple[str, str], fut: Future, vec: np.ndarray = None, exc: BaseException = None) -> None:
+    if vec is not None:
+        store_query(key[0], key[1], vec)
+    with _inflight_lock:
+        _inflight.pop(key, None)
+    if exc is not None:
+        fut.set_exception(exc)
+    else:
+        fut.set_result(vec)
+
+def _query_batch_result(backend: EmbeddingBackend, texts: List[str]) -> embed_client.BatchResult:
+    """
+    Embed cả batch câu hỏi; một câu hỏi lỗi không kéo theo các câu khác: remote thì
+    call_batch chia nhỏ tới từng câu, backend cục bộ thì gọi lại từng câu một.
+    """
+    if backend.remote:
+        return embed_client.call_batch(backend.embed, texts, TASK_QUERY, priority=True)
+    try:
+        return embed_client.BatchResult(dict(enumerate(backend.embed(texts, TASK_QUERY))))
+    except Exception:
+        if len(texts) <= 1:
+            raise
+    res = embed_client.BatchResult()
+    for i, text in enumerate(texts):
+        try:
+            res.vectors[i] = backend.embed([text], TASK_QUERY)[0]
+        except Exception as e:
+            res.errors[i] = e
+    return res
+
+def _run_query_batch(backend: EmbeddingBackend, items: List[Tuple[str, Tuple[str, str], Future]]) -> None:
+    """Một lần gọi backend cho cả batch câu hỏi; trả kết quả (hoặc lỗi riêng) cho từng Future."""
+    try:
+        res = _query_batch_result(backend, [q for q, _, _ in items])
+    except BaseException as e:
+        for _, key, fut in items:
+            _settle(key, fut, exc=e)
+        return
+    for i, (_, key, fut) in enumerate(items):
+        if i in res.errors:
+            _settle(key, fut, exc=res.errors[i])
+        else:
+            _settle(key, fut, _l2_normalize(np.asarray(res.vectors[i], dtype=np.float32)[None, :])[0])
+
+class _QueryBatcher:
+    """
+    Gom các câu hỏi đến trong QUERY_BATCH_WAIT_MS (tối đa QUERY_BATCH_MAX câu) thành một
+    lần gọi backend. Một thread nền gom batch; batch remote chạy trên pool câu hỏi riêng của
+    embed_client (không xếp sau batch ingest) và được ưu tiên slot trong giới hạn AIMD.
+    """
+
+    def __init__(self):
+        self._queue: "Queue[Tuple[EmbeddingBackend, str, Tuple[str, str], Future]]" = Queue()
+        self._thread: threading.Thread = None
+        self._lock = threading.Lock()
+        self.batches = 0
+        self.items = 0
+
+    def submit(self, backend: EmbeddingBackend, q: str, key: Tuple[str, str], fut: Future) -> None:
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._loop, name="embed-query-batcher", daemon=True)
+                self._thread.start()
+        self._queue.put((backend, q, key, fut))
+
+    def _collect(self) -> list:
+        batch = [self._queue.get()]
+        max_items = max(1, get_int("QUERY_BATCH_MAX", 32))
+        deadline = time.monotonic() + max(0.0, get_float("QUERY_BATCH_WAIT_MS", 5)) / 1000
+        while len(batch) < max_items:
+            timeout = deadline - time.monotonic()
+            try:
+                batch.append(self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait())
+            except Empty:
+                break
+        return batch
+
+    def _loop(self) -> None:
+        while True:
+            batch = self._collect()
+            groups: Dict[str, list] = {}
+            for backend, q, key, fut in batch:
+                groups.setdefault(backend.name, [backend]).append((q, key, fut))
+            for backend, *items in groups.values():
+                self.batches += 1
+                self.items += len(items)
+                if backend.remote:
+                    embed_client.query_executor().submit(_run_query_batch, backend, items)
+                else:
+                    _run_query_batch(backend, items)
+
+    def stats(self) -> Dict:
+        return {
+            "batches": self.batches,
+            "queries": self.items,
+            "avg_batch": round(self.items / self.batches, 2) if self.batches else 0.0,
+        }
+
+_batcher = _QueryBatcher()
+
+def query_batch_stats() -> Dict:
+    return _batcher.stats()
+
+def _query_key(backend: EmbeddingBackend, q: str) -> Tuple[str, str]:
+    return _cache_namespace(backend, TASK_QUERY), sha1_text(q)
+
 def embed_query(q: str) -> np.ndarray:
-    return embed_texts([q])
+    """Embedding (1, D) L2-normalized cho câu hỏi."""
+    backend = get_backend()
+    key = _query_key(backend, q)
+    vec = fetch_query(*key)
+    if vec is None:
+        fut, leader = _join_or_lead(key)
+        if leader:
+            _batcher.submit(backend, q, key, fut)
+        vec = fut.result()
+    return vec[None, :].copy()
+
+async def aembed_query(q: str) -> np.ndarray:
+    """Phiên bản async của embed_query (không chặn event loop)."""
+    backend = get_backend()
+    key = _query_key(backend, q)
+    vec = fetch_query(*key)
+    if vec is None:
+        fut, leader = _join_or_lead(key)
+        if leader:
+            _batcher.submit(backend, q, key, fut)
+        # shield: request bị huỷ không được huỷ Future dùng chung với các caller khác
+        vec = await asyncio.shield(asyncio.wrap_future(fut))
+    return vec[None, :].copy()
@@ -1,16 +1,10 @@
 from __future__ import annotations
 from typing import Iterable, List, Tuple
-import regex as re
 import numpy as np
-from rank_bm25 import BM25Okapi
 from app.utils.schema import Chunk
-
-_WORD = re.compile(r"\p{L}+\p{M}*|\d+", re.UNICODE)
-
-
-def _tokenize(text: str) -> List[str]:
-    # tokenizer đơn giản cho TV: lấy chuỗi chữ (có dấu) & số → lower
-    return [t.lower() for t in _WORD.findall(text or "")]
+from app.utils.config import get_int
+from app.rag.bm25_index import _tokenize
+from app.rag.mmr import mmr_select
 
 
 def _norm01(x: np.ndarray) -> np.ndarray:
@@ -33,140 +27,148 @@ def hybrid_retrieve(
     mmr_lambda: float = 0.5,
     recency_weight: float = 0.0,  # ← NEW: Weight cho recency boost
     recency_mode: str = "exponential",  # ← NEW: Decay mode
+    nprobe: int | None = None,
+    ef_search: int | None = None,
 ) -> List[Chunk]:
     """
     Kết hợp dense (cosine) + sparse (BM25) rồi MMR.
     - query_vec: (D,) đã L2-norm
-    - store: FAISSStore hiện tại (có .items)
+    - store: FAISSStore hiện tại (có .dense_scores / .exact_vectors / .metas / .texts)
     - docs: danh sách tài liệu cho phép (None = tất cả)
+    - nprobe / ef_search: tham số tìm kiếm khi store dùng index IVF / HNSW
     """
-    allow = set(docs or [])
-    # chọn candidates theo filter tài liệu
-    cand_ids = [
-        i
-        for i, it in enumerate(store.items)
-        if not allow or it.meta.get("doc") in allow
-    ]
-    if not cand_ids:
+    q_tokens = _tokenize(query_text)
+
+    # chọn candidates theo filter tài liệu (chỉ các dòng của tài liệu được chọn)
+    if store.is_ann:
+        # store lớn: chỉ chấm điểm hợp của top ANN (dense) và top BM25 (sparse);
+        # filter tài liệu được đẩy xuống dense search
+        pool_k = get_int("HYBRID_ANN_CANDIDATES", 200)
+        dense_rows = store.dense_candidates(
+            query_vec, pool_k, nprobe=nprobe, ef_search=ef_search, docs=docs
+        )
+        sparse_rows = store.bm25.matching_rows(q_tokens)
+        if docs:
+            sparse_rows = sparse_rows[store.doc_mask(docs)[sparse_rows]]
+        if sparse_rows.size > pool_k:
+            s = store.bm25.get_scores(q_tokens, sparse_rows)
+            sparse_rows = sparse_rows[np.argpartition(-s, pool_k - 1)[:pool_k]]
+        cand_ids = np.union1d(dense_rows, sparse_rows)
+    else:
+        cand_ids = store.doc_rows(docs)
+    if cand_ids.size == 0:
         return []
 
     # Check embedding dimension consistency
-    if store.items and query_vec.shape[0] != store.items[0].vec.shape[0]:
+    if query_vec.shape[0] != store.vectors.shape[1]:
         query_dim = query_vec.shape[0]
-        store_dim = store.items[0].vec.shape[0]
+        store_dim = store.vectors.shape[1]
         raise ValueError(
             f"Embedding dimension mismatch: query_dim={query_dim} != store_dim={store_dim}. "
             "This usually happens when the embedding model changed after documents were ingested. "
             "Please re-ingest the documents (or clear the vector store) so all embeddings share the same dimension."
         )
 
+    query_vec = np.asarray(query_vec, dtype=np.float32)
+
     # 1) Dense sims (cosine), đã L2 nên dot = cosine in [-1,1] → map về [0,1]
-    dense_sims = np.array(
-        [float(store.items[i].vec @ query_vec) for i in cand_ids], dtype=np.float32
-    )
+    #    (store sq8: gần đúng trên mã int8, shortlist được chấm lại chính xác ở bước 5)
+    if cand_ids.size == store.vectors.shape[0]:
+        dense_sims = store.dense_scores(query_vec)
+    else:
+        dense_sims = store.dense_scores(query_vec, cand_ids)
     dense01 = (dense_sims + 1.0) / 2.0
 
-    # 2) BM25 sims
-    corpus_tokens = [_tokenize(store.items[i].text) for i in cand_ids]
-    bm25 = BM25Okapi(corpus_tokens)
-    q_tokens = _tokenize(query_text)
-    bm25_scores = np.array(bm25.get_scores(q_tokens), dtype=np.float32)
+    # 2) BM25 sims: dùng inverted index của store, chỉ duyệt postings của term trong câu hỏi
+    bm25_scores = store.bm25.get_scores(q_tokens, cand_ids)
     bm2501 = _norm01(bm25_scores)
 
-    # 3) Kết hợp dense + sparse thành điểm hybrid cơ bản
-    combo = (1.0 - alpha) * dense01 + alpha * bm2501
-
     recency_scores: np.ndarray | None = None
 
-    # 4) Áp dụng recency boost (nếu bật)
+    # 3) Tính recency boost (nếu bật)
     if recency_weight > 0:
         # Import ở đây để tránh circular dependency
         from datetime import datetime
 
         current_time = datetime.now().timestamp()
 
-        # Compute recency scores
-        recency_scores = []
-        for gid in cand_ids:
-            item = store.items[gid]
-            timestamp = item.meta.get("upload_timestamp", 0) if item.meta else 0
-
-            if timestamp > 0:
-                age_days = (current_time - timestamp) / 86400.0
-                if recency_mode == "exponential":
-                    half_life = 30.0
-                    recency = np.exp(-age_days / half_life)
-                elif recency_mode == "linear":
-                    max_age = 90.0
-                    recency = max(0.0, 1.0 - (age_days / max_age))
-                elif recency_mode == "step":
-                    if age_days <= 7:
-                        recency = 1.0
-                    elif age_days <= 30:
-                        recency = 0.8
-                    elif age_days <= 90:
-                        recency = 0.5
-                    else:
-                        recency = 0.2
-                else:
-                    recency = 1.0
-            else:
-                recency = 0.5  # Default for unknown timestamp
-
-            recency_scores.append(recency)
-
-        recency_scores = np.array(recency_scores, dtype=np.float32)
-
-        # Combine: (1 - recency_weight) * hybrid + recency_weight * recency
-        combo = (1.0 - recency_weight) * combo + recency_weight * recency_scores
+        # Compute recency scores (vector hoá trên cột upload_timestamp)
+        timestamps = store.upload_timestamps[cand_ids]
+        age_days = (current_time - timestamps) / 86400.0
+        if recency_mode == "exponential":
+            half_life = 30.0
+            recency_scores = np.exp(-age_days / half_life)
+        elif recency_mode == "linear":
+            max_age = 90.0
+            recency_scores = np.maximum(0.0, 1.0 - (age_days / max_age))
+        elif recency_mode == "step":
+            recency_scores = np.select(
+                [age_days <= 7, age_days <= 30, age_days <= 90],
+                [1.0, 0.8, 0.5],
+                default=0.2,
+            )
+        else:
+            recency_scores = np.ones_like(age_days)
+        # Default for unknown timestamp
+        recency_scores = np.where(timestamps > 0, recency_scores, 0.5).astype(
+            np.float32
+        )
 
-    # 5) Sort và lấy top candidates
-    order = np.argsort(-combo)[: max(top_k * 3, top_k)]
-    cand_top = [cand_ids[j] for j in order.tolist()]
+    def _combine(ix=slice(None)) -> np.ndarray:
+        # 4) Kết hợp dense + sparse thành điểm hybrid cơ bản
+        c = (1.0 - alpha) * dense01[ix] + alpha * bm2501[ix]
+        if recency_scores is not None:
+            # Combine: (1 - recency_weight) * hybrid + recency_weight * recency
+            c = (1.0 - recency_weight) * c + recency_weight * recency_scores[ix]
+        return c
 
-    score_meta = {}
-    for idx, gid in enumerate(cand_ids):
+    combo = _combine()
+
+    # 5) Sort và lấy top candidates
+    n_top = min(max(top_k * 3, top_k), combo.shape[0])
+    if store.quantized:
+        # shortlist rộng hơn theo điểm gần đúng, chấm lại dense bằng vector float
+        n_short = min(2 * n_top, combo.shape[0])
+        short = np.argpartition(-combo, n_short - 1)[:n_short]
+        dense_sims[short] = store.exact_vectors(cand_ids[short]) @ query_vec
+        dense01[short] = (dense_sims[short] + 1.0) / 2.0
+        combo[short] = _combine(short)
+        order = short[np.argpartition(-combo[short], n_top - 1)[:n_top]]
+    else:
+        order = np.argpartition(-combo, n_top - 1)[:n_top]
+    order = order[np.argsort(-combo[order], kind="stable")]
+    cand_top = cand_ids[order]
+
+    def _score_meta(j: int) -> dict:
         meta_entry = {
-            "dense_score_raw": float(dense_sims[idx]),
-            "dense_score": float(dense01[idx]),
-            "bm25_score_raw": float(bm25_scores[idx]),
-            "bm25_score": float(bm2501[idx]),
-            "hybrid_score": float(combo[idx]),
+            "dense_score_raw": float(dense_sims[j]),
+            "dense_score": float(dense01[j]),
+            "bm25_score_raw": float(bm25_scores[j]),
+            "bm25_score": float(bm2501[j]),
+            "hybrid_score": float(combo[j]),
         }
 
         # Add recency info nếu có
-        if (
-            recency_weight > 0
-            and recency_scores is not None
-            and len(recency_scores) > idx
-        ):
-            meta_entry["recency_score"] = float(recency_scores[idx])
-
-        score_meta[gid] = meta_entry
+        if recency_weight > 0 and recency_scores is not None:
+            meta_entry["recency_score"] = float(recency_scores[j])
+        return meta_entry
 
     # 6) MMR (trên vector dense) để đa dạng
-    chosen: list[int] = []
-    while len(chosen) < min(top_k, len(cand_top)):
-        best_gid = None
-        best_val = -1e9
-        for gid in cand_top:
-            if gid in chosen:
-                continue
-            sim_q = float(store.items[gid].vec @ query_vec)  # [-1,1]
-            rep = 0.0
-            for sel in chosen:
-                rep = max(rep, float(store.items[gid].vec @ store.items[sel].vec))
-            mmr = mmr_lambda * sim_q - (1 - mmr_lambda) * rep
-            if mmr > best_val:
-                best_val, best_gid = mmr, gid
-        chosen.append(best_gid)
+    top_vecs = store.exact_vectors(cand_top)
+    chosen = mmr_select(
+        top_vecs,
+        top_vecs @ query_vec,  # [-1,1]
+        k=top_k,
+        lambda_=mmr_lambda,
+        non_negative_redundancy=True,
+    ).tolist()  # vị trí trong cand_top
 
     # 7) Xuất dạng Chunk
     out: List[Chunk] = []
-    for gid in chosen:
-        it = store.items[gid]
-        meta = dict(it.meta or {})
-        meta.update(score_meta.get(gid, {}))
+    for j in chosen:
+        gid = int(cand_top[j])
+        meta = dict(store.metas[gid] or {})
+        meta.update(_score_meta(int(order[j])))
 
         # ✅ FIX: Extract enhanced metadata to top-level Chunk fields
         out.append(
@@ -174,7 +176,7 @@ def hybrid_retrieve(
                 doc_name=meta.get("doc", "unknown"),
                 page=meta.get("page", 0),
                 chunk_id=meta.get("chunk_id", 0),
-                text=it.text,
+                text=store.texts[gid],
                 n_tokens=0,
                 score=meta.get("hybrid_score", 0.0),
                 meta=meta,
@@ -0,0 +1,166 @@
+from __future__ import annotations
+import math
+import os
+
+import faiss
+import numpy as np
+
+from app.utils.config import get_int
+
+# Các loại index hỗ trợ (đều dùng inner product = cosine vì vector đã L2-norm)
+INDEX_KINDS = ("flat", "ivf", "hnsw", "ivfpq")
+
+# số vector tối thiểu để train; ít hơn thì vẫn dùng flat
+_MIN_TRAIN = {"ivf": 1000, "ivfpq": 10000}
+
+
+def index_kind(index) -> str:
+    if isinstance(index, faiss.IndexHNSW):
+        return "hnsw"
+    if isinstance(index, faiss.IndexIVFPQ):
+        return "ivfpq"
+    if isinstance(index, faiss.IndexIVF):
+        return "ivf"
+    return "flat"
+
+
+def _as_ivf(index):
+    try:
+        return faiss.extract_index_ivf(index)
+    except Exception:
+        return None
+
+
+def target_kind(n: int) -> str:
+    """
+    Loại index mong muốn cho store có `n` vector.
+    - FAISS_INDEX_TYPE=flat|ivf|hnsw|ivfpq: cố định (fallback flat khi chưa đủ dữ liệu train)
+    - FAISS_INDEX_TYPE=auto (mặc định): flat, tự nâng lên FAISS_PROMOTE_TYPE khi n >= FAISS_PROMOTE_AT
+    """
+    kind = os.getenv("FAISS_INDEX_TYPE", "auto").strip().lower()
+    if kind == "auto":
+        if n < get_int("FAISS_PROMOTE_AT", 20000):
+            return "flat"
+        kind = os.getenv("FAISS_PROMOTE_TYPE", "hnsw").strip().lower()
+    if kind not in INDEX_KINDS:
+        print(f"FAISS index type không hợp lệ: {kind}; dùng flat")
+        return "flat"
+    if n < _MIN_TRAIN.get(kind, 0):
+        return "flat"
+    return kind
+
+
+def _nlist(n: int) -> int:
+    # ~4*sqrt(n) cụm, mỗi cụm có ít nhất ~39 điểm train (khuyến nghị của faiss)
+    return max(1, min(int(4 * math.sqrt(max(n, 1))), n // 39))
+
+
+def _pq_m(dim: int) -> int:
+    # số sub-quantizer: ước lớn nhất của dim, <= dim/8 (768 -> 96 bytes/vector)
+    for m in range(max(1, dim // 8), 0, -1):
+        if dim % m == 0:
+            return m
+    return 1
+
+
+def build_index(kind: str, dim: int, vectors: np.ndarray | None = None):
+    """Tạo index theo loại, train (nếu cần) trên `vectors` rồi add toàn bộ."""
+    n = 0 if vectors is None else int(vectors.shape[0])
+    if kind == "hnsw":
+        index = faiss.IndexHNSWFlat(
+            dim, get_int("FAISS_HNSW_M", 32), faiss.METRIC_INNER_PRODUCT
+        )
+        index.hnsw.efConstruction = get_int("FAISS_EF_CONSTRUCTION", 80)
+    elif kind in ("ivf", "ivfpq") and n:
+        quantizer = faiss.IndexFlatIP(dim)
+        nlist = _nlist(n)
+        if kind == "ivf":
+            index = faiss.IndexIVFFlat(
+                quantizer, dim, nlist, faiss.METRIC_INNER_PRODUCT
+            )
+        else:
+            index = faiss.IndexIVFPQ(
+                quantizer, dim, nlist, _pq_m(dim), 8, faiss.METRIC_INNER_PRODUCT
+            )
+        index.train(vectors)
+    else:
+        index = faiss.IndexFlatIP(dim)
+    if n:
+        index.add(vectors)
+    return index
+
+
+def search_params(
+    index, nprobe: int | None = None, ef_search: int | None = None, sel=None
+):
+    """
+    SearchParameters theo loại index (nprobe cho IVF, efSearch cho HNSW);
+    `sel` (IDSelector) giới hạn các label được trả về.
+    """
+    kind = index_kind(index)
+    if kind in ("ivf", "ivfpq"):
+        return faiss.SearchParametersIVF(
+            nprobe=int(nprobe or get_int("FAISS_NPROBE", 16)), sel=sel
+        )
+    if kind == "hnsw":
+        return faiss.SearchParametersHNSW(
+            efSearch=int(ef_search or get_int("FAISS_EF_SEARCH", 64)), sel=sel
+        )
+    if sel is not None:
+        return faiss.SearchParameters(sel=sel)
+    return None
+
+
+def widened_search_params(
+    index, k: int, nprobe: int | None = None, ef_search: int | None = None, sel=None
+):
+    """
+    Tham số cho lần search lại khi filter (IDSelector) làm thiếu kết quả: HNSW dừng ở
+    efSearch, IVF chỉ quét nprobe cụm. efSearch gấp 4 (ít nhất 4k), nprobe gấp 4 (tối đa nlist).
+    """
+    nprobe = 4 * int(nprobe or get_int("FAISS_NPROBE", 16))
+    ivf = _as_ivf(index)
+    if ivf is not None:
+        nprobe = min(nprobe, int(ivf.nlist))
+    ef_search = max(4 * int(ef_search or get_int("FAISS_EF_SEARCH", 64)), 4 * int(k))
+    return search_params(index, nprobe=nprobe, ef_search=ef_search, sel=sel)
+
+
+def bitmap_selector(mask: np.ndarray):
+    """IDSelector theo mask bool trên số dòng (label = số dòng)."""
+    bitmap = np.packbits(np.asarray(mask, dtype=bool), bitorder="little")
+    sel = faiss.IDSelectorBitmap(int(mask.shape[0]), faiss.swig_ptr(bitmap))
+    # selector chỉ giữ con trỏ: gắn bitmap vào để không bị thu hồi khi đang search
+    sel._bitmap = bitmap
+    return sel
+
+
+def reconstruct_all(index, n: int) -> np.ndarray:
+    """Lấy n vector đầu từ index (IVF cần direct map để reconstruct)."""
+    ivf = _as_ivf(index)
+    if ivf is not None:
+        ivf.make_direct_map()
+    return index.reconstruct_n(0, n)
+
+
+def reconstruct_rows(index, rows: np.ndarray) -> np.ndarray:
+    """Lấy vector của các dòng `rows` (label = số dòng) từ index."""
+    ivf = _as_ivf(index)
+    if ivf is not None and ivf.direct_map.type == faiss.DirectMap.NoMap:
+        ivf.make_direct_map()
+    rows = np.asarray(rows, dtype=np.int64)
+    if rows.size == 0:
+        return np.zeros((0, index.d), dtype=np.float32)
+    return index.reconstruct_batch(rows)
+
+
+def index_bytes_per_vector(index) -> int:
+    """Ước lượng số byte/vector mà index giữ (chưa tính cấu trúc phụ nhỏ)."""
+    kind = index_kind(index)
+    if kind == "ivfpq":
+        return int(faiss.extract_index_ivf(index).code_size) + 8  # code + id
+    if kind == "ivf":
+        return 4 * index.d + 8
+    if kind == "hnsw":
+        return 4 * index.d + 4 * index.hnsw.nb_neighbors(0)  # vector + cạnh tầng 0
+    return 4 * index.d
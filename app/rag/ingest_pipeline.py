@@ -0,0 +1,127 @@
+from __future__ import annotations
+import asyncio, inspect, time
+from typing import Callable, Dict, Iterable, List
+
+from app.rag.chunking import chunk_pages
+from app.utils.schema import Chunk
+
+# Ingest nhiều tầng chạy gối nhau: đọc PDF → chunk → embed → ghi store.
+# Mỗi tầng có số worker riêng, giữa hai tầng là hàng đợi có giới hạn nên trong lúc
+# tài liệu N đang embed thì tài liệu N+1 đã được đọc/chunk và batch của tài liệu N-1
+# đang ghi vào store; tổng thời gian tiến về thời gian của tầng chậm nhất thay vì tổng.
+# Bộ nhớ đỉnh tỉ lệ với kích thước batch × độ dài hàng đợi, không theo cả lô upload.
+
+class EmptyDocument(ValueError):
+    """Tài liệu không tạo được chunk nào (PDF rỗng / OCR thất bại)."""
+
+    def __init__(self, doc_name: str):
+        super().__init__(doc_name)
+        self.doc_name = doc_name
+
+class DocBatch:
+    """Batch chunk liên tiếp thứ `index` (trên `total`) của một tài liệu, kèm `info` của tài liệu."""
+
+    def __init__(self, doc_name: str, chunks: List[Chunk], index: int, total: int, info: dict):
+        self.doc_name = doc_name
+        self.chunks = chunks
+        self.index = index
+        self.total = total
+        self.info = info
+
+def split_batches(doc_name: str, pages: list, meta: dict, info: dict,
+                  chunk_size: int, overlap: int, batch_chunks: int) -> List[DocBatch]:
+    """Chunk một tài liệu rồi chia thành các DocBatch tối đa `batch_chunks` chunk."""
+    chunks = chunk_pages(pages, doc_name=doc_name, chunk_size=chunk_size, overlap=overlap, **meta)
+    if not chunks:
+        raise EmptyDocument(doc_name)
+    info = dict(info, pages=len(pages), chunks=len(chunks))
+    step = max(1, batch_chunks)
+    total = (len(chunks) + step - 1) // step
+    return [DocBatch(doc_name, chunks[lo:lo + step], i, total, info)
+            for i, lo in enumerate(range(0, len(chunks), step))]
+
+class Stage:
+    """
+    Một tầng pipeline: `fn(item)` chạy trên `workers` worker song song.
+    - fn thường (đọc PDF, chunk) chạy trong thread; fn async (embed, ghi store) chạy trên event loop
+    - fan_out=True: fn trả về list, từng phần tử được đẩy sang tầng sau
+    - fn trả về None: không đẩy gì sang tầng sau
+    """
+
+    def __init__(self, name: str, fn: Callable, workers: int = 1, fan_out: bool = False):
+        self.name = name
+        self.fn = fn
+        self.workers = max(1, workers)
+        self.fan_out = fan_out
+        self.items = 0
+        self.busy_s = 0.0
+        self.first_start = None
+        self.last_end = None
+
+    async def call(self, item):
+        t = time.perf_counter()
+        if self.first_start is None:
+            self.first_start = t
+        try:
+            if inspect.iscoroutinefunction(self.fn):
+                return await self.fn(item)
+            return await asyncio.to_thread(self.fn, item)
+        finally:
+            end = time.perf_counter()
+            self.busy_s += end - t
+            self.items += 1
+            self.last_end = end
+
+    def timing(self) -> Dict:
+        wall = (self.last_end - self.first_start) if self.first_start is not None else 0.0
+        return {
+            "workers": self.workers,
+            "items": self.items,
+            "busy_ms": int(self.busy_s * 1000),
+            "wall_ms": int(wall * 1000),
+        }
+
+_DONE = object()
+
+async def run_stages(source: Iterable, stages: List[Stage], max_queued: int = 4) -> Dict[str, Dict]:
+    """
+    Chạy `source` qua các tầng; trả về timing từng tầng {name: {workers, items, busy_ms, wall_ms}}.
+    Lỗi ở bất kỳ tầng nào huỷ toàn bộ pipeline và được raise lại.
+    """
+    queues = [asyncio.Queue(maxsize=max(1, max_queued)) for _ in range(len(stages) + 1)]
+    alive = [stage.workers for stage in stages]
+
+    async def feed():
+        for item in source:
+            await queues[0].put(item)
+        await queues[0].put(_DONE)
+
+    async def work(i: int, stage: Stage):
+        q_in, q_out = queues[i], queues[i + 1]
+        while True:
+            item = await q_in.get()
+            if item is _DONE:
+                await q_in.put(_DONE)  # cho các worker cùng tầng cũng dừng
+                alive[i] -= 1
+                if alive[i] == 0:
+                    await q_out.put(_DONE)
+                return
+            out = await stage.call(item)
+            if out is None:
+                continue
+            for x in (out if stage.fan_out else (out,)):
+                await q_out.put(x)
+
+    async def drain():
+        while await queues[-1].get() is not _DONE:
+            pass
+
+    tasks = [asyncio.ensure_future(feed()), asyncio.ensure_future(drain())]
+    for i, stage in enumerate(stages):
+        tasks += [asyncio.ensure_future(work(i, stage)) for _ in range(stage.workers)]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        for t in tasks:
+            t.cancel()
+    return {stage.name: stage.timing() for stage in stages}
@@ -0,0 +1,43 @@
+from __future__ import annotations
+import numpy as np
+
+
+def mmr_select(
+    cand_vecs: np.ndarray,
+    query_sims: np.ndarray,
+    k: int,
+    lambda_: float = 0.5,
+    non_negative_redundancy: bool = False,
+) -> np.ndarray:
+    """
+    Maximal Marginal Relevance (vector hoá), dùng chung cho FAISSStore và hybrid.
+    - cand_vecs: (n, d) vector ứng viên (đã L2-norm)
+    - query_sims: (n,) sim(q, i)
+    - non_negative_redundancy: True → redundancy = max(0, max_j sim(i, j))
+    Trả về vị trí (trong cand_vecs) theo thứ tự được chọn.
+
+    Ma trận sim ứng viên×ứng viên tính một lần; vector redundancy lớn nhất
+    được cập nhật tăng dần sau mỗi lần chọn, chọn bằng argmax.
+    """
+    n = int(cand_vecs.shape[0])
+    k = min(int(k), n)
+    if k <= 0:
+        return np.zeros(0, dtype=np.int64)
+
+    query_sims = np.asarray(query_sims, dtype=np.float32)
+    pair_sims = cand_vecs @ cand_vecs.T
+    rep = np.full(n, 0.0 if non_negative_redundancy else -np.inf, dtype=np.float32)
+    taken = np.zeros(n, dtype=bool)
+    chosen = np.empty(k, dtype=np.int64)
+
+    # lần chọn đầu chưa có redundancy → chỉ xét sim(q, i)
+    scores = lambda_ * query_sims
+    for t in range(k):
+        if t:
+            scores = lambda_ * query_sims - (1 - lambda_) * rep
+        scores = np.where(taken, -np.inf, scores)
+        best = int(np.argmax(scores))
+        chosen[t] = best
+        taken[best] = True
+        np.maximum(rep, pair_sims[best], out=rep)
+    return chosen
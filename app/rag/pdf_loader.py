@@ -1,26 +1,56 @@
 # app/rag/pdf_loader.py
 from __future__ import annotations
-from typing import List, Tuple, Union
+from typing import List, Optional, Tuple, Union
 import os
 import re
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from concurrent.futures.process import BrokenProcessPool
 
 import pypdfium2 as pdfium
 from PIL import Image
 
+from app.utils import procpool
+from app.utils.config import get_int
+
 try:
     import pytesseract
 
-    TESSERACT_AVAILABLE = True
+    _HAS_PYTESSERACT = True
     # ưu tiên biến môi trường trỏ tới tesseract.exe (Windows)
     if os.getenv("TESSERACT_CMD"):
         pytesseract.pytesseract.tesseract_cmd = os.getenv("TESSERACT_CMD")
 except Exception:
-    TESSERACT_AVAILABLE = False
+    _HAS_PYTESSERACT = False
+
+try:
+    # binding C-API của Tesseract (tùy chọn): engine sống lâu trong process
+    import tesserocr
+
+    _HAS_TESSEROCR = True
+except Exception:
+    _HAS_TESSEROCR = False
+
+TESSERACT_AVAILABLE = _HAS_PYTESSERACT or _HAS_TESSEROCR
 
 TextPage = Tuple[int, str]  # (page_number, text)
 
 _WS_RE = re.compile(r"\s+")
 
+# pdfium không thread-safe: mọi thao tác trên PdfDocument trong process đi qua lock này
+# (ingest có thể chạy nhiều worker đọc PDF cùng lúc)
+_PDFIUM_LOCK = threading.Lock()
+
+
+def _close(obj) -> None:
+    """Đóng PdfDocument / PdfPage / PdfBitmap (bản pypdfium2 cũ không có close())."""
+    try:
+        obj.close()
+    except AttributeError:
+        pass
+
 
 def _normalize_ws(s: str) -> str:
     return _WS_RE.sub(" ", s or "").strip()
@@ -40,81 +70,369 @@ def _detect_repeated(
     return {k for k, c in bag.items() if c >= min_repeat}
 
 
+def _page_text(page: pdfium.PdfPage) -> str:
+    tp = page.get_textpage()
+    # pypdfium2 khuyến cáo dùng get_text_bounded cho default args
+    return tp.get_text_bounded() or ""
+
+
 def _extract_text_pdfium(doc: pdfium.PdfDocument) -> list[str]:
-    out: list[str] = []
-    for page in doc:
-        tp = page.get_textpage()
-        # pypdfium2 khuyến cáo dùng get_text_bounded cho default args
-        txt = tp.get_text_bounded() or ""
-        out.append(txt)
+    return [_page_text(page) for page in doc]
+
+
+def _extract_range(path: str, lo: int, hi: int) -> list[str]:
+    """Worker process: mở PdfDocument riêng từ file và trích text layer các trang [lo, hi)."""
+    doc = pdfium.PdfDocument(path)
+    try:
+        return [_page_text(doc[i]) for i in range(lo, hi)]
+    finally:
+        _close(doc)
+
+
+@contextmanager
+def _as_path(source: Union[str, bytes, bytearray]):
+    """Đường dẫn cho worker process tự mở file; nguồn bytes được ghi ra file tạm một lần."""
+    if not isinstance(source, (bytes, bytearray)):
+        yield os.fspath(source)
+        return
+    fd, tmp_path = tempfile.mkstemp(suffix=".pdf")
+    try:
+        with os.fdopen(fd, "wb") as w:
+            w.write(source)
+        yield tmp_path
+    finally:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+
+
+def _extract_text_parallel(
+    source: Union[str, bytes, bytearray], n_pages: int
+) -> Optional[list[str]]:
+    """
+    Chia tài liệu thành các khoảng trang (~4 khoảng/worker, tối thiểu PDF_RANGE_MIN_PAGES trang)
+    và trích text layer trên process pool; mỗi worker tự mở file. Nguồn bytes được ghi ra
+    file tạm để worker đọc thay vì gửi cả PDF qua IPC cho từng khoảng. None nếu pool lỗi.
+    """
+    step = max(get_int("PDF_RANGE_MIN_PAGES", 16), -(-n_pages // (procpool.n_workers() * 4)))
+    ranges = [(lo, min(lo + step, n_pages)) for lo in range(0, n_pages, step)]
+    try:
+        with _as_path(source) as path:
+            pool = procpool.get_pool()
+            futs = [pool.submit(_extract_range, path, lo, hi) for lo, hi in ranges]
+            return [txt for fut in futs for txt in fut.result()]
+    except BrokenProcessPool as e:
+        print(f"⚠️  Trích text song song lỗi ({e}); chạy tuần tự")
+        procpool.discard(pool)
+        return None
+
+
+def _ocr_doc_pages(doc: pdfium.PdfDocument, indices: List[int], lang: str) -> List[dict]:
+    """
+    OCR các trang `indices` của doc đang mở; mỗi trang trả về {page, text, engine, ms, dpi}
+    hoặc error. Chỉ bước render giữ _PDFIUM_LOCK, Tesseract chạy ngoài lock nên các worker
+    đọc PDF khác trong process không phải chờ OCR.
+    """
+    out: List[dict] = []
+    engine = _ocr_backend()
+    for i in indices:
+        t = time.perf_counter()
+        rec = {"page": i + 1}
+        try:
+            with _PDFIUM_LOCK:
+                page = doc[i]
+                try:
+                    scale = _ocr_scale(page)
+                    image = engine.render(page, scale) if engine else None
+                finally:
+                    _close(page)
+            rec["dpi"] = int(round(scale * 72))
+            rec["text"], rec["engine"] = (
+                engine.recognize(image, scale, lang) if engine else ("", "")
+            )
+        except Exception as e:
+            rec["error"] = str(e)
+        rec["ms"] = int((time.perf_counter() - t) * 1000)
+        out.append(rec)
     return out
 
 
-def _ocr_page(page: pdfium.PdfPage, scale: float = 2.0, lang: str = "vie+eng") -> str:
-    if not TESSERACT_AVAILABLE:
-        return ""
-    # render bitmap rồi chuyển PIL để OCR
-    bitmap = page.render(scale=scale).to_pil()
-    if not isinstance(bitmap, Image.Image):
-        bitmap = Image.fromarray(bitmap)
-    text = pytesseract.image_to_string(bitmap, lang=lang)
-    return text or ""
+def _ocr_range(path: str, indices: List[int], lang: str) -> List[dict]:
+    """Worker process: mở PdfDocument riêng rồi OCR các trang được giao."""
+    doc = pdfium.PdfDocument(path)
+    try:
+        return _ocr_doc_pages(doc, indices, lang)
+    finally:
+        _close(doc)
+
+
+def _ocr_parallel(
+    source: Union[str, bytes, bytearray], indices: List[int], lang: str
+) -> Optional[List[dict]]:
+    """
+    Lập lịch OCR trên process pool: mỗi task OCR_PAGES_PER_TASK trang nên worker rảnh nhận
+    việc tiếp (trang khó/dễ không làm lệch tải). None nếu pool lỗi.
+    """
+    per_task = max(1, get_int("OCR_PAGES_PER_TASK", 1))
+    groups = [indices[lo:lo + per_task] for lo in range(0, len(indices), per_task)]
+    try:
+        with _as_path(source) as path:
+            pool = procpool.get_pool()
+            futs = [pool.submit(_ocr_range, path, g, lang) for g in groups]
+            return [rec for fut in futs for rec in fut.result()]
+    except BrokenProcessPool as e:
+        print(f"⚠️  OCR song song lỗi ({e}); chạy tuần tự")
+        procpool.discard(pool)
+        return None
+
+
+def _ocr_targets(raw_texts: List[str], ocr: bool) -> List[int]:
+    """
+    Trang cần OCR: trang không có text layer; khi bật `ocr` thì thêm các trang có ít hơn
+    OCR_MIN_TEXT_CHARS ký tự (trang đã có đủ text không OCR lại).
+    """
+    min_chars = get_int("OCR_MIN_TEXT_CHARS", 50) if ocr else 1
+    return [i for i, t in enumerate(raw_texts) if len(_normalize_ws(t)) < max(1, min_chars)]
+
+
+def _page_count(source: Union[str, bytes, bytearray]) -> int:
+    with _PDFIUM_LOCK:
+        doc = pdfium.PdfDocument(source)
+        try:
+            return len(doc)
+        finally:
+            _close(doc)
+
+
+def _ocr_scale(page: pdfium.PdfPage) -> float:
+    """
+    Scale render theo khổ trang: cạnh dài ≈ OCR_TARGET_PX pixel, DPI kẹp trong
+    [OCR_MIN_DPI, OCR_MAX_DPI] (khổ A4 ≈ 200 DPI; trang nhỏ không bị phóng quá lớn,
+    trang khổ lớn không render ra ảnh khổng lồ).
+    """
+    try:
+        width, height = page.get_size()  # đơn vị point = 1/72 inch
+    except Exception:
+        return 2.0
+    long_in = max(width, height, 1.0) / 72.0
+    dpi = get_int("OCR_TARGET_PX", 2400) / long_in
+    dpi = min(max(dpi, get_int("OCR_MIN_DPI", 150)), get_int("OCR_MAX_DPI", 300))
+    return dpi / 72.0
+
+
+class _PytesseractOCR:
+    """
+    tesseract CLI qua pytesseract: mỗi trang một subprocess + file ảnh tạm, nạp lại model ngôn ngữ.
+    render() gọi pdfium (caller giữ _PDFIUM_LOCK), recognize() chỉ chạm ảnh đã chép ra.
+    """
+
+    name = "pytesseract"
+
+    def render(self, page: pdfium.PdfPage, scale: float):
+        """Ảnh PIL của trang, không còn tham chiếu bộ nhớ của bitmap pdfium."""
+        bitmap = page.render(scale=scale)
+        try:
+            image = bitmap.to_pil()
+            if not isinstance(image, Image.Image):
+                image = Image.fromarray(image)
+            return image.copy()
+        finally:
+            _close(bitmap)
+
+    def recognize(self, image, scale: float, lang: str) -> Tuple[str, str]:
+        """Trả về (text, tên engine đã dùng)."""
+        return pytesseract.image_to_string(image, lang=lang) or "", self.name
+
+
+class _TesserocrOCR:
+    """
+    Tesseract C-API qua tesserocr: mỗi process giữ một PyTessBaseAPI cho mỗi `lang`
+    (model ngôn ngữ chỉ nạp một lần, dùng lại cho mọi trang); bitmap xám của pdfium
+    đưa thẳng vào SetImageBytes, không encode PNG / ghi file tạm.
+    Không khởi tạo được engine (thiếu tessdata...) → dùng `fallback` nếu có.
+    """
+
+    name = "tesserocr"
+
+    def __init__(self, fallback: Optional[_PytesseractOCR] = None):
+        self.fallback = fallback
+        self._apis: dict = {}
+        self._lock = threading.Lock()
+
+    def _api(self, lang: str):
+        if lang not in self._apis:
+            kwargs = {"lang": lang}
+            if os.getenv("TESSDATA_PREFIX"):
+                kwargs["path"] = os.getenv("TESSDATA_PREFIX")
+            try:
+                self._apis[lang] = tesserocr.PyTessBaseAPI(**kwargs)
+            except Exception as e:
+                if self.fallback is None:
+                    raise
+                print(f"⚠️  tesserocr không khởi tạo được ({e}); OCR '{lang}' dùng pytesseract")
+                self._apis[lang] = None
+        return self._apis[lang]
+
+    def render(self, page: pdfium.PdfPage, scale: float) -> Tuple[bytes, int, int, int, int]:
+        """Bitmap xám của trang dạng (bytes, width, height, channels, stride) đã chép ra khỏi pdfium."""
+        bitmap = page.render(scale=scale, grayscale=True, rev_byteorder=True)
+        try:
+            return (
+                bytes(bitmap.buffer),
+                bitmap.width,
+                bitmap.height,
+                bitmap.n_channels,
+                bitmap.stride,
+            )
+        finally:
+            _close(bitmap)
+
+    def recognize(self, image, scale: float, lang: str) -> Tuple[str, str]:
+        """Trả về (text, tên engine đã dùng)."""
+        with self._lock:
+            api = self._api(lang)
+            if api is not None:
+                api.SetImageBytes(*image)
+                # DPI thật của bitmap (mặc định Tesseract đoán sai với ảnh không có metadata)
+                api.SetSourceResolution(int(round(scale * 72)))
+                try:
+                    return api.GetUTF8Text() or "", self.name
+                finally:
+                    api.Clear()
+        # fallback chạy ngoài lock: các trang không phải chờ nhau qua từng subprocess
+        data, width, height, _, stride = image
+        gray = Image.frombuffer("L", (width, height), data, "raw", "L", stride, 1)
+        return self.fallback.recognize(gray, scale, lang)
+
+
+_ocr_engine = None
+_ocr_engine_lock = threading.Lock()
+
+
+def _ocr_backend():
+    """
+    Engine OCR của process này theo OCR_BACKEND: auto (mặc định; tesserocr nếu có, không thì
+    pytesseract) | tesserocr | pytesseract. None nếu không có engine nào dùng được.
+    """
+    global _ocr_engine
+    with _ocr_engine_lock:
+        if _ocr_engine is None:
+            kind = os.getenv("OCR_BACKEND", "auto").strip().lower()
+            fallback = _PytesseractOCR() if _HAS_PYTESSERACT else None
+            if kind == "pytesseract":
+                _ocr_engine = fallback
+            elif _HAS_TESSEROCR and kind in ("auto", "tesserocr"):
+                _ocr_engine = _TesserocrOCR(fallback)
+            else:
+                if kind not in ("auto", "tesserocr"):
+                    print(f"OCR_BACKEND không hợp lệ: {kind}; dùng auto")
+                _ocr_engine = fallback
+            _ocr_engine = _ocr_engine or False
+        return _ocr_engine or None
+
+
+def _ocr_page(
+    page: pdfium.PdfPage, scale: float = 2.0, lang: str = "vie+eng"
+) -> Tuple[str, str]:
+    """OCR một trang → (text, tên engine đã dùng trong process này)."""
+    engine = _ocr_backend()
+    if engine is None:
+        return "", ""
+    with _PDFIUM_LOCK:
+        image = engine.render(page, scale)
+    return engine.recognize(image, scale, lang)
 
 
 def load_pdf(
-    source: Union[str, bytes, bytearray], ocr: bool = False, ocr_lang: str = "vie+eng"
+    source: Union[str, bytes, bytearray],
+    ocr: bool = False,
+    ocr_lang: str = "vie+eng",
+    stats: Optional[dict] = None,
 ) -> List[TextPage]:
     """
     Trả về danh sách (page_number, text) đã loại header/footer lặp.
-    - Nếu `ocr=False`: chỉ trích text layer.
-    - Nếu `ocr=True`: trang nào không có text sẽ OCR; hoặc OCR toàn bộ nếu muốn.
+    - Nếu `ocr=False`: chỉ trích text layer; trang không có text mới OCR.
+    - Nếu `ocr=True`: OCR thêm các trang có quá ít text (OCR_MIN_TEXT_CHARS).
     Có thể truyền vào đường dẫn file hoặc nội dung PDF dạng bytes.
+    Tài liệu từ PDF_PARALLEL_MIN_PAGES trang trở lên được trích text song song trên
+    process pool dùng chung (PROCESS_POOL_WORKERS); OCR nhiều trang cũng chạy trên pool này.
+    Header/footer lặp được loại sau khi ghép. `stats` (nếu truyền) nhận thời gian trích
+    text, engine OCR (OCR_BACKEND) và thời gian OCR từng trang.
     """
-    doc = pdfium.PdfDocument(source)
-    try:
-        # 1) lấy text layer trước
-        raw_texts = _extract_text_pdfium(doc)
+    t0 = time.perf_counter()
+    raw_texts = None
+    if procpool.n_workers() > 1:
+        min_pages = get_int("PDF_PARALLEL_MIN_PAGES", 64)
+        n_pages = _page_count(source) if min_pages > 0 else 0
+        if min_pages > 0 and n_pages >= min_pages:
+            raw_texts = _extract_text_parallel(source, n_pages)
+    if raw_texts is None:
+        with _PDFIUM_LOCK:
+            doc = pdfium.PdfDocument(source)
+            try:
+                # 1) lấy text layer trước
+                raw_texts = _extract_text_pdfium(doc)
+            finally:
+                _close(doc)
+    extract_ms = int((time.perf_counter() - t0) * 1000)
 
-        # 2) OCR fallback (khi bật ocr=True hoặc trang rỗng)
-        if ocr and not TESSERACT_AVAILABLE:
+    # 2) OCR fallback: chỉ các trang thiếu text, không duyệt lại cả tài liệu
+    ocr_pages: List[dict] = []
+    targets = _ocr_targets(raw_texts, ocr)
+    engine = _ocr_backend()
+    if targets and engine is None:
+        if ocr:
             # cảnh báo mềm (không raise để app tiếp tục chạy)
             print(
-                "⚠️  OCR được bật nhưng pytesseract/tesseract chưa sẵn sàng. Bỏ qua OCR."
+                "⚠️  OCR được bật nhưng tesserocr/pytesseract chưa sẵn sàng. Bỏ qua OCR."
             )
-
-        if ocr or any(_normalize_ws(t) == "" for t in raw_texts):
-            for i, page in enumerate(doc):
-                if not ocr and _normalize_ws(raw_texts[i]) != "":
-                    continue  # đã có text, không OCR
-                if TESSERACT_AVAILABLE:
-                    try:
-                        ocr_txt = _ocr_page(page, scale=2.0, lang=ocr_lang)
-                        raw_texts[i] = ocr_txt or raw_texts[i]
-                    except Exception as e:
-                        # không chặn pipeline
-                        print(f"⚠️  OCR lỗi ở trang {i+1}: {e}")
-
-        # 3) loại header/footer lặp & normalize
-        lines_per_page = [
-            [ln for ln in (pg.splitlines() or []) if ln.strip()] for pg in raw_texts
+    elif targets:
+        t1 = time.perf_counter()
+        if procpool.n_workers() > 1 and len(targets) > 1:
+            ocr_pages = _ocr_parallel(source, targets, ocr_lang) or []
+        if not ocr_pages:
+            # _ocr_doc_pages chỉ giữ _PDFIUM_LOCK khi render từng trang
+            with _PDFIUM_LOCK:
+                doc = pdfium.PdfDocument(source)
+            try:
+                ocr_pages = _ocr_doc_pages(doc, targets, ocr_lang)
+            finally:
+                with _PDFIUM_LOCK:
+                    _close(doc)
+        for rec in ocr_pages:
+            if "error" in rec:
+                # không chặn pipeline
+                print(f"⚠️  OCR lỗi ở trang {rec['page']}: {rec['error']}")
+            elif rec.get("text"):
+                raw_texts[rec["page"] - 1] = rec["text"]
+        if stats is not None:
+            stats["ocr_ms"] = int((time.perf_counter() - t1) * 1000)
+            # engine thực sự dùng trong các worker (có thể fallback sang pytesseract)
+            used = sorted({rec["engine"] for rec in ocr_pages if rec.get("engine")})
+            stats["ocr_backend"] = ",".join(used) or engine.name
+    if stats is not None:
+        stats["extract_ms"] = extract_ms
+        stats["ocr_pages"] = [
+            {k: v for k, v in rec.items() if k != "text"} for rec in ocr_pages
         ]
-        heads = _detect_repeated(lines_per_page, "head")
-        tails = _detect_repeated(lines_per_page, "tail")
-
-        cleaned_pages: List[TextPage] = []
-        for idx, lines in enumerate(lines_per_page, start=1):
-            if not lines:
-                cleaned_pages.append((idx, ""))
-                continue
-            if lines and _normalize_ws(lines[0])[:120] in heads:
-                lines = lines[1:]
-            if lines and _normalize_ws(lines[-1])[:120] in tails:
-                lines = lines[:-1]
-            text = _normalize_ws(" ".join(lines))
-            cleaned_pages.append((idx, text))
-        return cleaned_pages
-    finally:
-        try:
-            doc.close()
-        except AttributeError:
-            pass
+
+    # 3) loại header/footer lặp & normalize
+    lines_per_page = [
+        [ln for ln in (pg.splitlines() or []) if ln.strip()] for pg in raw_texts
+    ]
+    heads = _detect_repeated(lines_per_page, "head")
+    tails = _detect_repeated(lines_per_page, "tail")
+
+    cleaned_pages: List[TextPage] = []
+    for idx, lines in enumerate(lines_per_page, start=1):
+        if not lines:
+            cleaned_pages.append((idx, ""))
+            continue
+        if lines and _normalize_ws(lines[0])[:120] in heads:
+            lines = lines[1:]
+        if lines and _normalize_ws(lines[-1])[:120] in tails:
+            lines = lines[:-1]
+        text = _normalize_ws(" ".join(lines))
+        cleaned_pages.append((idx, text))
+    return cleaned_pages
@@ -0,0 +1,36 @@
+from __future__ import annotations
+import numpy as np
+
+# Scalar quantization int8 theo từng dòng: v ≈ code * scale / 127
+# (scale = max|v| của dòng). Không cần train, chịu được dữ liệu mới lệch phân phối.
+CODECS = ("float32", "sq8")
+
+_BLOCK_ROWS = 16384
+
+
+def sq8_encode(vectors: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    scale = np.abs(vectors).max(axis=1) if vectors.size else np.zeros(0, np.float32)
+    scale = np.where(scale > 0, scale, 1.0).astype(np.float32)
+    codes = np.rint(vectors / scale[:, None] * 127.0)
+    return np.clip(codes, -127, 127).astype(np.int8), scale
+
+
+def sq8_decode(codes: np.ndarray, scale: np.ndarray) -> np.ndarray:
+    return codes.astype(np.float32) * (scale[:, None] / 127.0)
+
+
+def sq8_dot(codes: np.ndarray, scale: np.ndarray, query_vec: np.ndarray) -> np.ndarray:
+    """codes @ q gần đúng, tính theo khối để không tạo bản sao float32 toàn ma trận."""
+    q = np.asarray(query_vec, dtype=np.float32)
+    out = np.empty(codes.shape[0], dtype=np.float32)
+    for lo in range(0, codes.shape[0], _BLOCK_ROWS):
+        hi = lo + _BLOCK_ROWS
+        out[lo:hi] = codes[lo:hi].astype(np.float32) @ q
+    return out * (scale / 127.0)
+
+
+def bytes_per_vector(codec: str, dim: int) -> int:
+    if codec == "sq8":
+        return dim + 4  # int8 codes + scale float32
+    return 4 * dim
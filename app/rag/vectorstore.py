@@ -1,80 +1,448 @@
 from __future__ import annotations
-from dataclasses import dataclass
+from collections import OrderedDict
 from typing import List, Dict
 import numpy as np
 import faiss
 import os
 import json
+import shutil
+import sys
+import threading
+import time
 
 from app.utils.schema import Chunk
+from app.utils.config import get_int, get_float
+from app.rag.bm25_index import BM25Index
+from app.rag.mmr import mmr_select
+from app.rag.index_factory import (
+    bitmap_selector,
+    build_index,
+    index_bytes_per_vector,
+    index_kind,
+    reconstruct_all,
+    reconstruct_rows,
+    search_params,
+    target_kind,
+    widened_search_params,
+)
+from app.rag.quantize import (
+    CODECS,
+    bytes_per_vector,
+    sq8_decode,
+    sq8_dot,
+    sq8_encode,
+)
 
 
-@dataclass
-class VSItem:
-    vec: np.ndarray  # (d,)
-    meta: Dict
-    text: str
+def _fsync(path: str) -> None:
+    with open(path, "r+b") as f:
+        os.fsync(f.fileno())
 
 
 class FAISSStore:
+    """
+    Vector store theo session.
+    Vector lưu trong một ma trận float32 liên tục (n, d); metadata là các cột
+    song song theo số dòng (metas, texts, doc id, upload_timestamp) để dense
+    scoring / lọc tài liệu chỉ là một phép nhân ma trận-vector và một mask.
+
+    Lưu trữ trên disk gồm snapshot (faiss_index.bin, vectors.npy, items.jsonl,
+    bm25_index.json trong `snapshots/<generation>/`) cộng các segment log
+    chỉ-ghi-thêm trong `segments/`: mỗi lần add/xoá chỉ append bản ghi mới
+    (add + vector, hoặc tombstone theo tài liệu); compaction chạy nền gộp log vào
+    snapshot khi log đủ lớn. store_meta.json là điểm commit duy nhất: nó chỉ định
+    snapshot hiện hành cùng `segments_upto`, nên crash giữa chừng không để lại
+    snapshot lệch với log.
+
+    Xoá tài liệu chỉ đánh dấu tombstone trên các dòng (O(số chunk bị xoá));
+    label FAISS luôn bằng số dòng nên index giữ nguyên, search bỏ qua dòng chết
+    bằng IDSelector. Khi tombstone vượt ngưỡng, index mới được dựng nền từ các
+    dòng còn sống rồi thay vào (purge).
+
+    add / remove_doc / search / clear giữ `self.lock` nên có thể gọi từ nhiều
+    thread; caller đọc nhiều bước liên tiếp (hybrid_retrieve) giữ lock bên ngoài.
+
+    RAG_RESIDENT_CODEC=sq8: bản sao vector trong RAM lưu dạng int8 (scale theo
+    dòng) thay vì float32; điểm dense tính gần đúng trên mã int8 rồi chấm lại
+    chính xác shortlist bằng vector float lấy từ FAISS index (exact_vectors).
+    """
+
     def __init__(self, db_path: str, dim: int):
         self.db_path = db_path
         self._dim = dim
+        codec = os.getenv("RAG_RESIDENT_CODEC", "float32").strip().lower()
+        if codec not in CODECS:
+            print(f"RAG_RESIDENT_CODEC không hợp lệ: {codec}; dùng float32")
+            codec = "float32"
+        self.codec = codec
         # dùng inner product (đã chuẩn hoá = cosine)
         self.index = faiss.IndexFlatIP(dim)
-        self.items: List[VSItem] = []
-        self.docs_set = set()
+        self._init_columns(dim)
+        # inverted index BM25 theo số dòng
+        self.bm25 = BM25Index()
+        # trạng thái segment log
+        self._active_gen = 0
+        self._log_records = 0
+        self._snapshot_n = 0
+        self._compact_lock = threading.Lock()
+        # tuần tự hoá add/xoá/search giữa các thread (ingest chạy add qua to_thread)
+        self.lock = threading.RLock()
+        # purge tombstone chạy nền
+        self._purge_job: Dict | None = None
 
-        if os.path.exists(db_path):
-            print(f"Tải index từ {db_path}")
-            self.index = faiss.read_index(db_path)
+        store_meta = self._read_store_meta()
+        snapshot_upto = store_meta.get("segments_upto", -1)
+        self._snapshot_base = self._snapshot_folder(store_meta)
+        index_path = self._index_file_path()
+        has_snapshot = bool(index_path) and os.path.exists(index_path)
+        if has_snapshot:
+            print(f"Tải index từ {index_path}")
+            self.index = faiss.read_index(index_path)
             self._dim = self.index.d
+            self._init_columns(self._dim)
         self._ensure_items_loaded()
+        self._snapshot_n = self._n
+        self._replay_segments(snapshot_upto)
+        self._maybe_purge()
+        if not has_snapshot and self._n:
+            # store chỉ có log (dưới ngưỡng compaction): ghi snapshot một lần để lần tải sau
+            # dùng vectors.npy + BM25 đã lưu thay vì replay và tokenize lại toàn bộ
+            self.compact(background=True)
+
+    # ---- cột dữ liệu theo dòng ----
+    @property
+    def quantized(self) -> bool:
+        return self.codec == "sq8"
+
+    def _init_columns(self, dim: int, capacity: int = 0):
+        self._n = 0
+        self._dead = 0
+        # số dòng có thể đã đổi → job purge đang chạy (nếu có) không còn hợp lệ
+        self._epoch = getattr(self, "_epoch", 0) + 1
+        self._alive = np.zeros(capacity, dtype=bool)
+        # ước lượng byte của texts + metas (Python object), cộng dồn khi append
+        self._payload_bytes = 0
+        vec_dtype = np.int8 if self.quantized else np.float32
+        self._vecs = np.zeros((capacity, dim), dtype=vec_dtype)
+        self._row_scale = np.ones(capacity if self.quantized else 0, dtype=np.float32)
+        self._timestamps = np.zeros(capacity, dtype=np.float64)
+        self.metas: List[Dict] = []
+        self.texts: List[str] = []
+        # tài liệu -> các khoảng dòng [lo, hi) (chunk của một tài liệu thường liền nhau)
+        self._doc_ranges: Dict[str, List[List[int]]] = {}
+        self.docs_set = set()
+
+    def _reserve(self, extra: int):
+        need = self._n + extra
+        cap = self._vecs.shape[0]
+        if need <= cap:
+            return
+        new_cap = max(need, cap * 2, 64)
+        vecs = np.zeros((new_cap, self._vecs.shape[1]), dtype=self._vecs.dtype)
+        vecs[: self._n] = self._vecs[: self._n]
+        if self.quantized:
+            row_scale = np.ones(new_cap, dtype=np.float32)
+            row_scale[: self._n] = self._row_scale[: self._n]
+            self._row_scale = row_scale
+        ts = np.zeros(new_cap, dtype=np.float64)
+        ts[: self._n] = self._timestamps[: self._n]
+        alive = np.zeros(new_cap, dtype=bool)
+        alive[: self._n] = self._alive[: self._n]
+        self._vecs, self._timestamps, self._alive = vecs, ts, alive
+
+    def _append_rows(self, vectors: np.ndarray, metas: List[Dict], texts: List[str]):
+        k = len(metas)
+        self._reserve(k)
+        lo, hi = self._n, self._n + k
+        if self.quantized:
+            self._vecs[lo:hi], self._row_scale[lo:hi] = sq8_encode(vectors)
+        else:
+            self._vecs[lo:hi] = vectors
+        self._append_columns(metas, texts, lo)
+
+    def _append_columns(self, metas: List[Dict], texts: List[str], lo: int):
+        hi = lo + len(metas)
+        # gán cột theo khối thay vì từng phần tử numpy
+        docs = [meta.get("doc") for meta in metas]
+        start = 0
+        for i in range(1, len(docs) + 1):
+            if i < len(docs) and docs[i] == docs[start]:
+                continue
+            if docs[start]:
+                ranges = self._doc_ranges.setdefault(docs[start], [])
+                if ranges and ranges[-1][1] == lo + start:
+                    ranges[-1][1] = lo + i
+                else:
+                    ranges.append([lo + start, lo + i])
+            start = i
+        self._timestamps[lo:hi] = [
+            float(meta.get("upload_timestamp") or 0.0) for meta in metas
+        ]
+        self._alive[lo:hi] = True
+        self.docs_set.update(d for d in docs if d)
+        self._payload_bytes += sum(sys.getsizeof(t) for t in texts) + sum(
+            sys.getsizeof(m) + sum(sys.getsizeof(v) for v in m.values()) for m in metas
+        )
+        self.metas.extend(metas)
+        self.texts.extend(texts)
+        self._n = hi
+
+    def _keep_rows(self, keep: np.ndarray):
+        """Giữ lại các dòng theo mask/chỉ số (dùng khi purge tombstone)."""
+        rows = np.flatnonzero(keep) if keep.dtype == bool else keep
+        vecs = self._vecs[rows]
+        alive = self._alive[rows]
+        row_scale = self._row_scale[rows] if self.quantized else None
+        metas = [self.metas[i] for i in rows.tolist()]
+        texts = [self.texts[i] for i in rows.tolist()]
+        self._init_columns(self._vecs.shape[1], capacity=len(metas))
+        # chép thẳng mã int8 + scale, không mã hoá lại
+        self._vecs[: len(metas)] = vecs
+        if self.quantized:
+            self._row_scale[: len(metas)] = row_scale
+        self._append_columns(metas, texts, 0)
+        # tài liệu đã xoá (tombstone) không còn trong docs_set
+        self.docs_set = {
+            m.get("doc") for m, ok in zip(metas, alive.tolist()) if ok and m.get("doc")
+        }
+        self._alive[: len(metas)] = alive
+        self._dead = int(len(metas) - alive.sum())
+
+    @property
+    def vectors(self) -> np.ndarray:
+        """
+        View (n, d) liên tục của bản sao vector trong RAM
+        (float32, hoặc mã int8 khi codec = sq8 — khi đó dùng exact_vectors/dense_scores).
+        """
+        return self._vecs[: self._n]
+
+    def dense_scores(self, query_vec: np.ndarray, rows: np.ndarray | None = None) -> np.ndarray:
+        """sim(q, row) cho các dòng `rows` (None = tất cả); gần đúng nếu codec = sq8."""
+        query_vec = np.asarray(query_vec, dtype=np.float32)
+        codes = self.vectors if rows is None else self._vecs[rows]
+        if not self.quantized:
+            return codes @ query_vec
+        scale = self._row_scale[: self._n] if rows is None else self._row_scale[rows]
+        return sq8_dot(codes, scale, query_vec)
+
+    def exact_vectors(self, rows: np.ndarray | None = None) -> np.ndarray:
+        """Vector float32 của các dòng `rows` (None = tất cả), dùng để chấm lại shortlist."""
+        if rows is None:
+            rows = np.arange(self._n, dtype=np.int64)
+        rows = np.asarray(rows, dtype=np.int64)
+        if not self.quantized:
+            return self._vecs[rows]
+        if int(self.index.ntotal) == self._n and self.index_kind != "ivfpq":
+            try:
+                return reconstruct_rows(self.index, rows)
+            except Exception as e:
+                print(f"Không reconstruct được từ index ({e}); dùng vector giải mã sq8.")
+        return sq8_decode(self._vecs[rows], self._row_scale[rows])
+
+    def memory_report(self) -> Dict:
+        """Số byte/chunk của bản sao vector trong RAM (trước/sau lượng tử hoá) và của index."""
+        dim = int(self._vecs.shape[1])
+        resident = bytes_per_vector(self.codec, dim)
+        return {
+            "codec": self.codec,
+            "index_kind": self.index_kind,
+            "chunks": self._n - self._dead,
+            "tombstones": self._dead,
+            "dim": dim,
+            "float32_bytes_per_chunk": bytes_per_vector("float32", dim),
+            "resident_bytes_per_chunk": resident,
+            "index_bytes_per_chunk": index_bytes_per_vector(self.index),
+            "resident_bytes_total": resident * self._n,
+            "store_bytes_total": self.memory_bytes(),
+        }
+
+    def memory_bytes(self) -> int:
+        """Ước lượng RAM của store: cột theo dòng, FAISS index, texts/metas và BM25."""
+        columns = sum(
+            a.nbytes
+            for a in (self._vecs, self._row_scale, self._timestamps, self._alive)
+        )
+        index = index_bytes_per_vector(self.index) * int(self.index.ntotal)
+        return int(columns + index + self._payload_bytes + self.bm25.approx_bytes())
+
+    @property
+    def busy(self) -> bool:
+        """Đang có compaction ghi file nền (chưa nên bỏ store khỏi cache)."""
+        return self._compact_lock.locked()
+
+    @property
+    def upload_timestamps(self) -> np.ndarray:
+        return self._timestamps[: self._n]
+
+    @property
+    def alive(self) -> np.ndarray:
+        """Mask bool theo dòng: False = dòng đã xoá (tombstone), chờ purge."""
+        return self._alive[: self._n]
+
+    def doc_rows(self, docs) -> np.ndarray:
+        """
+        Các dòng còn sống (tăng dần) của tập tài liệu `docs` (rỗng/None = tất cả);
+        chi phí theo số chunk của các tài liệu được chọn.
+        """
+        allow = set(docs or [])
+        if not allow:
+            return np.flatnonzero(self.alive)
+        parts = [
+            np.arange(lo, hi, dtype=np.int64)
+            for d in allow
+            for lo, hi in self._doc_ranges.get(d, ())
+        ]
+        if not parts:
+            return np.zeros(0, dtype=np.int64)
+        rows = np.sort(np.concatenate(parts))
+        return rows[self._alive[rows]]
+
+    def doc_mask(self, docs) -> np.ndarray:
+        """Mask bool theo dòng (còn sống) cho tập tài liệu `docs` (rỗng/None = tất cả)."""
+        if not docs:
+            return self.alive.copy()
+        mask = np.zeros(self._n, dtype=bool)
+        mask[self.doc_rows(docs)] = True
+        return mask
+
+    def __len__(self) -> int:
+        return self._n - self._dead
+
+    def _folder(self) -> str:
+        return os.path.dirname(self.db_path)
+
+    def _snapshots_dir(self) -> str:
+        return os.path.join(self._folder(), "snapshots")
+
+    def _snapshot_folder(self, store_meta: Dict) -> str | None:
+        """
+        Thư mục snapshot mà store_meta chỉ định (None = chưa có snapshot);
+        store cũ (store_meta chưa có khoá "snapshot") dùng file ngay trong thư mục session.
+        """
+        if "snapshot" not in store_meta:
+            return self._folder()
+        name = store_meta.get("snapshot")
+        return os.path.join(self._folder(), name) if name else None
+
+    def _snapshot_file(self, fname: str, base: str | None = None) -> str | None:
+        base = base or self._snapshot_base
+        return os.path.join(base, fname) if base else None
+
+    def _index_file_path(self, base: str | None = None) -> str | None:
+        return self._snapshot_file(os.path.basename(self.db_path), base)
+
+    def _items_file_path(self, base: str | None = None) -> str | None:
+        return self._snapshot_file("items.jsonl", base)
 
-    def _items_file_path(self) -> str:
-        folder = os.path.dirname(self.db_path)
-        return os.path.join(folder, "items.jsonl")
+    def _vectors_file_path(self, base: str | None = None) -> str | None:
+        return self._snapshot_file("vectors.npy", base)
+
+    def _meta_file_path(self) -> str:
+        return os.path.join(self._folder(), "store_meta.json")
+
+    def _segments_dir(self) -> str:
+        return os.path.join(self._folder(), "segments")
+
+    def _segment_paths(self, gen: int) -> tuple[str, str]:
+        base = os.path.join(self._segments_dir(), f"{gen:08d}")
+        return base + ".jsonl", base + ".f32"
+
+    def _list_segments(self) -> List[int]:
+        folder = self._segments_dir()
+        if not os.path.isdir(folder):
+            return []
+        gens = set()
+        for fname in os.listdir(folder):
+            stem, ext = os.path.splitext(fname)
+            if ext in (".jsonl", ".f32") and stem.isdigit():
+                gens.add(int(stem))
+        return sorted(gens)
+
+    def _read_store_meta(self) -> Dict:
+        path = self._meta_file_path()
+        if not os.path.exists(path):
+            return {}
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except Exception as e:
+            print(f"Lỗi đọc store meta: {e}")
+            return {}
+
+    def _bm25_file_path(self, base: str | None = None) -> str | None:
+        return self._snapshot_file("bm25_index.json", base)
+
+    def _load_bm25(self):
+        """Tải inverted index BM25 từ disk; nếu thiếu/lệch thì dựng lại từ texts."""
+        path = self._bm25_file_path()
+        if path and os.path.exists(path):
+            try:
+                idx = BM25Index.load(path)
+                if len(idx) == self._n:
+                    self.bm25 = idx
+                    return
+                print("BM25 index lệch số lượng items; dựng lại.")
+            except Exception as e:
+                print(f"Lỗi tải BM25 index: {e}")
+        self.bm25 = BM25Index()
+        self.bm25.add_many(range(self._n), self.texts)
+        if path:
+            # lưu lại để lần tải sau không phải tokenize lại cả snapshot
+            try:
+                self.bm25.save(path)
+            except Exception as e:
+                print(f"Lỗi lưu BM25 index: {e}")
+
+    def _snapshot_vectors(self, n: int) -> np.ndarray:
+        """
+        Vector của snapshot: đọc sidecar vectors.npy nếu khớp, nếu không thì lấy một lần
+        từ FAISS index (reconstruct_n). Tải store là một lần đọc đầy đủ: vector được chép
+        vào ma trận RAM của store (ghi thêm tại chỗ) và faiss.read_index cũng đọc hết
+        index, nên không memory-map file.
+        """
+        path = self._vectors_file_path()
+        if path and os.path.exists(path):
+            try:
+                arr = np.load(path)
+                if arr.ndim == 2 and arr.shape[0] >= n and arr.shape[1] == self.index.d:
+                    return arr[:n]
+                print("vectors.npy lệch với index; dùng vector từ FAISS index.")
+            except Exception as e:
+                print(f"Lỗi đọc vectors.npy: {e}")
+        if index_kind(self.index) == "ivfpq":
+            print("⚠️  Thiếu vectors.npy: dùng vector dựng lại từ mã IVF-PQ (gần đúng).")
+        return reconstruct_all(self.index, n)
 
     def _try_load_items_from_disk(self):
         items_path = self._items_file_path()
-        if not os.path.exists(items_path):
+        if not items_path or not os.path.exists(items_path):
             return
         try:
-            loaded = []
+            # đọc metadata một lần rồi parse hàng loạt
             with open(items_path, "r", encoding="utf-8") as f:
-                for i, line in enumerate(f):
-                    line = line.strip()
-                    if not line:
-                        continue
-                    rec = json.loads(line)
-                    vec = None
-                    try:
-                        vec = self.index.reconstruct(i)
-                    except Exception:
-                        # nếu không reconstruct được (lệch số lượng), bỏ qua
-                        break
-                    loaded.append(
-                        VSItem(
-                            vec=np.array(vec, dtype=np.float32),
-                            meta=rec.get("meta", {}),
-                            text=rec.get("text", ""),
-                        )
-                    )
-            if loaded:
-                self.items = loaded
-                self.docs_set = {
-                    it.meta.get("doc") for it in self.items if it.meta.get("doc")
-                }
-                print(f"Tải metadata {len(self.items)} items từ {items_path}")
+                lines = [ln for ln in f.read().splitlines() if ln.strip()]
+            recs = json.loads("[" + ",".join(lines) + "]") if lines else []
+            # nếu lệch số lượng với index, chỉ lấy phần khớp
+            n = min(len(recs), int(self.index.ntotal))
+            if n:
+                vecs = self._snapshot_vectors(n)
+                self._init_columns(self.index.d, capacity=n)
+                self._append_rows(
+                    vecs,
+                    [rec.get("meta", {}) for rec in recs[:n]],
+                    [rec.get("text", "") for rec in recs[:n]],
+                )
+                print(f"Tải metadata {self._n} items từ {items_path}")
+                self._load_bm25()
         except Exception as e:
             print(f"Lỗi tải items metadata: {e}")
 
     def _ensure_items_loaded(self):
         if self.index.ntotal == 0:
-            self.items = []
-            self.docs_set = set()
+            self._init_columns(self.index.d)
+            self.bm25.clear()
             return
-        if not self.items or len(self.items) < int(self.index.ntotal):
+        if self._n < int(self.index.ntotal):
             self._try_load_items_from_disk()
 
     @property
@@ -82,10 +450,139 @@ class FAISSStore:
         return self.index.d
 
     def size(self) -> int:
-        return int(self.index.ntotal)
+        # số chunk còn sống (index vẫn giữ dòng tombstone tới khi purge)
+        return int(self.index.ntotal) - self._dead
 
     def add(self, vectors: np.ndarray, chunks: List[Chunk]):
-        assert vectors.shape[0] == len(chunks)
+        with self.lock:
+            assert vectors.shape[0] == len(chunks)
+            self._finish_purge()
+            vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+
+            metas: List[Dict] = []
+            for c in chunks:
+                # Preserve full metadata from chunk.meta, with fallback to basic fields
+                full_meta = {
+                    "doc": c.doc_name,
+                    "page": c.page,
+                    "chunk_id": c.chunk_id,
+                }
+                # Merge with chunk.meta to preserve additional fields like "filename"
+                if c.meta:
+                    full_meta.update(c.meta)
+                metas.append(full_meta)
+
+            texts = [c.text for c in chunks]
+            if vectors.shape[1] != self.index.d and self.index.ntotal:
+                raise ValueError(
+                    f"Embedding dim {vectors.shape[1]} != index dim {self.index.d}. Cannot add to non-empty index."
+                )
+            # ghi log trước: lỗi ghi log làm add() thất bại thay vì để dòng chỉ sống trong RAM
+            self._append_log_adds(vectors, metas, texts)
+            self._apply_adds(vectors, metas, texts)
+            self._maybe_compact()
+
+    # ---- segment log (append-only) ----
+    def _append_log_adds(
+        self, vectors: np.ndarray, metas: List[Dict], texts: List[str]
+    ):
+        jsonl_path, vec_path = self._segment_paths(self._active_gen)
+        os.makedirs(self._segments_dir(), exist_ok=True)
+        dim = int(vectors.shape[1])
+        # ghi vector trước; mỗi bản ghi add mang offset (số float) của vector trong .f32
+        # nên vector thừa của một lần ghi hỏng không làm lệch các bản ghi sau
+        with open(vec_path, "ab") as w:
+            w.seek(0, os.SEEK_END)
+            base = w.tell() // 4
+            w.write(vectors.tobytes())
+        lines = [
+            json.dumps(
+                {"op": "add", "dim": dim, "vec": base + i * dim, "meta": meta, "text": text},
+                ensure_ascii=False,
+            )
+            + "\n"
+            for i, (meta, text) in enumerate(zip(metas, texts))
+        ]
+        with open(jsonl_path, "a", encoding="utf-8") as w:
+            w.write("".join(lines))
+        self._log_records += len(metas)
+        print(f"Đã ghi thêm {len(metas)} items vào segment {jsonl_path}")
+
+    def _append_log_tombstone(self, doc_name: str, removed: int):
+        jsonl_path, _ = self._segment_paths(self._active_gen)
+        os.makedirs(self._segments_dir(), exist_ok=True)
+        with open(jsonl_path, "a", encoding="utf-8") as w:
+            rec = {"op": "del", "doc": doc_name}
+            w.write(json.dumps(rec, ensure_ascii=False) + "\n")
+        self._log_records += removed
+
+    def _replay_segments(self, snapshot_upto: int):
+        """Áp các segment mới hơn snapshot theo thứ tự generation."""
+        gens = [g for g in self._list_segments() if g > snapshot_upto]
+        for gen in gens:
+            jsonl_path, vec_path = self._segment_paths(gen)
+            if not os.path.exists(jsonl_path):
+                continue
+            raw = (
+                np.fromfile(vec_path, dtype=np.float32)
+                if os.path.exists(vec_path)
+                else np.zeros(0, dtype=np.float32)
+            )
+            # offset (số float) của bản ghi add cũ không ghi "vec": nối tiếp bản ghi trước
+            offset = 0
+            pending: List[Dict] = []
+
+            def _flush():
+                if not pending:
+                    return
+                dim = int(pending[0]["dim"])
+                offs = np.array([r["vec"] for r in pending], dtype=np.int64)
+                ok = offs + dim <= raw.size
+                recs = [r for r, good in zip(pending, ok.tolist()) if good]
+                if recs:
+                    self._apply_adds(
+                        raw[offs[ok][:, None] + np.arange(dim)],
+                        [r.get("meta", {}) for r in recs],
+                        [r.get("text", "") for r in recs],
+                    )
+                if len(recs) < len(pending):
+                    print(
+                        f"Segment {vec_path} thiếu vector; bỏ qua {len(pending) - len(recs)} items."
+                    )
+                self._log_records += len(recs)
+                pending.clear()
+
+            try:
+                with open(jsonl_path, "r", encoding="utf-8") as f:
+                    for line in f:
+                        line = line.strip()
+                        if not line:
+                            continue
+                        try:
+                            rec = json.loads(line)
+                        except ValueError:
+                            # dòng ghi dở (crash giữa lúc append)
+                            print(f"Bỏ qua bản ghi hỏng trong {jsonl_path}")
+                            continue
+                        if rec.get("op") == "add":
+                            if pending and rec.get("dim") != pending[0].get("dim"):
+                                _flush()
+                            dim = int(rec.get("dim") or 0)
+                            rec.setdefault("vec", offset)
+                            offset = int(rec["vec"]) + dim
+                            pending.append(rec)
+                        elif rec.get("op") == "del":
+                            _flush()
+                            self._log_records += self._apply_remove(rec.get("doc"))
+                _flush()
+            except Exception as e:
+                print(f"Lỗi replay segment {jsonl_path}: {e}")
+        if gens:
+            print(f"Đã replay {len(gens)} segment log, tổng {self._n} items")
+        self._active_gen = max(gens + [snapshot_upto]) + 1
+
+    def _apply_adds(self, vectors: np.ndarray, metas: List[Dict], texts: List[str]):
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
         # guard: rebuild index if empty and dim mismatches
         if vectors.shape[1] != self.index.d:
             if self.index.ntotal == 0:
@@ -94,220 +591,606 @@ class FAISSStore:
                 )
                 self.index = faiss.IndexFlatIP(int(vectors.shape[1]))
                 self._dim = int(vectors.shape[1])
+                self._init_columns(self._dim)
             else:
                 raise ValueError(
                     f"Embedding dim {vectors.shape[1]} != index dim {self.index.d}. Cannot add to non-empty index."
                 )
         self.index.add(vectors)
-        faiss.write_index(self.index, self.db_path)  # Lưu index sau khi thêm
-        print(f"Đã lưu index vào {self.db_path}")
-
-        for i, c in enumerate(chunks):
-            # Preserve full metadata from chunk.meta, with fallback to basic fields
-            full_meta = {
-                "doc": c.doc_name,
-                "page": c.page,
-                "chunk_id": c.chunk_id,
-            }
-            # Merge with chunk.meta to preserve additional fields like "filename"
-            if c.meta:
-                full_meta.update(c.meta)
-
-            self.items.append(
-                VSItem(
-                    vec=vectors[i],
-                    meta=full_meta,
-                    text=c.text,
-                )
-            )
-            self.docs_set.add(c.doc_name)
+        start_row = self._n
+        self._append_rows(vectors, metas, texts)
+        self.bm25.add_many(range(start_row, self._n), texts)
+        self._maybe_promote()
 
-        self._persist_items()
+    # ---- ANN index ----
+    @property
+    def index_kind(self) -> str:
+        return index_kind(self.index)
 
-    def _persist_items(self):
-        items_path = self._items_file_path()
-        if not self.items:
-            try:
-                if os.path.exists(items_path):
-                    os.remove(items_path)
-            except Exception as e:
-                print(f"Lỗi xoá metadata items: {e}")
+    @property
+    def is_ann(self) -> bool:
+        return self.index_kind != "flat"
+
+    def _maybe_promote(self):
+        """
+        Nâng index (flat -> IVF/HNSW/IVF-PQ) khi store vượt ngưỡng. Index mới được train/dựng
+        nền trên vector hiện có (cùng cơ chế với purge); thao tác ghi không chờ dựng xong,
+        store chuyển sang index mới (kèm các dòng thêm sau đó) ở thao tác kế tiếp.
+        """
+        kind = target_kind(self._n)
+        if kind == "flat" or kind == self.index_kind or self._purge_job is not None:
             return
+        print(f"Nâng FAISS index {self.index_kind} -> {kind} ({self._n} vectors), dựng nền")
+        self.purge(background=True)
+
+    def dense_candidates(
+        self,
+        query_vec: np.ndarray,
+        k: int,
+        nprobe: int | None = None,
+        ef_search: int | None = None,
+        docs=None,
+    ) -> np.ndarray:
+        """
+        Số dòng của top-k láng giềng gần nhất (còn sống) theo FAISS index,
+        giới hạn trong tập tài liệu `docs` nếu có:
+        - tập dòng nhỏ (<= FILTER_EXACT_MAX_ROWS) hoặc index flat: chấm trực tiếp các dòng đó
+        - ngược lại: đẩy filter vào FAISS search bằng IDSelector; nếu ANN trả thiếu
+          (filter chọn lọc) thì search lại với efSearch/nprobe lớn hơn, rồi chấm trực tiếp
+        """
+        live = self.size()
+        if live <= 0 or k <= 0:
+            return np.zeros(0, dtype=np.int64)
+        query_vec = np.asarray(query_vec, dtype=np.float32)
+        mask = None
+        if docs:
+            rows = self.doc_rows(docs)
+            if rows.size <= get_int("FILTER_EXACT_MAX_ROWS", 20000) or not self.is_ann:
+                return self._exact_top(query_vec, rows, k)
+            mask = np.zeros(self._n, dtype=bool)
+            mask[rows] = True
+            live = int(rows.size)
+        elif self._dead:
+            mask = self.alive
+        # dòng tombstone / ngoài tập tài liệu bị loại ngay trong FAISS search
+        sel = bitmap_selector(mask) if mask is not None else None
+        want = min(int(k), live)
+        params = search_params(self.index, nprobe=nprobe, ef_search=ef_search, sel=sel)
+        rows = self._index_search(query_vec, want, params)
+        if rows.size < want and sel is not None:
+            params = widened_search_params(
+                self.index, want, nprobe=nprobe, ef_search=ef_search, sel=sel
+            )
+            rows = self._index_search(query_vec, want, params)
+            if rows.size < want:
+                return self._exact_top(query_vec, np.flatnonzero(mask), want)
+        return rows
+
+    def _index_search(self, query_vec: np.ndarray, k: int, params) -> np.ndarray:
+        _, I = self.index.search(query_vec.reshape(1, -1), k, params=params)
+        rows = I[0]
+        return rows[rows >= 0].astype(np.int64)
+
+    def _exact_top(self, query_vec: np.ndarray, rows: np.ndarray, k: int) -> np.ndarray:
+        """Top-k trong tập dòng `rows` bằng chấm điểm trực tiếp (giảm dần theo điểm)."""
+        k = min(int(k), int(rows.size))
+        if k == 0:
+            return rows[:0]
+        sims = self.dense_scores(query_vec, rows)
+        top = np.argpartition(-sims, k - 1)[:k]
+        return rows[top[np.argsort(-sims[top], kind="stable")]]
+
+    # ---- compaction ----
+    def _maybe_compact(self):
+        threshold = max(
+            get_int("STORE_COMPACT_MIN_RECORDS", 2000),
+            int(get_float("STORE_COMPACT_RATIO", 0.5) * self._snapshot_n),
+        )
+        if self._log_records >= threshold:
+            self.compact(background=True)
+
+    def compact(self, background: bool = True) -> bool:
+        """
+        Gộp segment log vào snapshot. Trạng thái được "đóng băng" ngay trên
+        thread gọi (các ghi mới chuyển sang generation tiếp theo), phần ghi file
+        chạy nền nếu `background=True`. Trả về False nếu đang có compaction khác.
+        """
+        if not self._compact_lock.acquire(blocking=not background):
+            return False
+        try:
+            upto = self._active_gen
+            self._active_gen += 1
+            n = self._n
+            frozen = (
+                faiss.clone_index(self.index),
+                # các dòng < n không bị ghi đè tại chỗ nên view là đủ;
+                # bản int8 (sq8) được đổi sang float ở thread nền
+                self.vectors,
+                self._row_scale[:n] if self.quantized else None,
+                self.alive.copy(),
+                list(self.metas),
+                list(self.texts),
+                self.bm25.copy(),
+                n,
+            )
+            self._log_records = 0
+            self._snapshot_n = n
+        except Exception:
+            self._compact_lock.release()
+            raise
+        if background:
+            threading.Thread(
+                target=self._write_snapshot, args=(upto, *frozen), daemon=True
+            ).start()
+        else:
+            self._write_snapshot(upto, *frozen)
+        return True
+
+    def _write_snapshot(
+        self,
+        upto: int,
+        index,
+        vectors,
+        row_scale,
+        alive,
+        metas,
+        texts,
+        bm25: BM25Index,
+        n: int,
+    ):
         try:
-            with open(items_path, "w", encoding="utf-8") as w:
-                for it in self.items:
-                    rec = {"meta": it.meta, "text": it.text}
-                    w.write(json.dumps(rec, ensure_ascii=False) + "\n")
-            print(f"Đã lưu metadata items vào {items_path}")
+            # snapshot mới ghi vào thư mục riêng theo generation; chưa được dùng tới
+            # khi store_meta trỏ tới nó
+            rel = os.path.join("snapshots", f"{upto:08d}")
+            base = os.path.join(self._folder(), rel)
+            shutil.rmtree(base, ignore_errors=True)  # bản dở dang của lần crash trước
+            if n and row_scale is not None:
+                # sq8: float lấy từ index chỉ khi index giữ nguyên vector (flat/HNSW/IVF-Flat);
+                # IVF-PQ chỉ còn mã PQ → giải mã bản int8, không bao giờ lưu vector dựng
+                # lại từ PQ (mỗi lần compaction sẽ train lại trên sai số tích luỹ)
+                if index_kind(index) == "ivfpq":
+                    vectors = sq8_decode(np.asarray(vectors), row_scale)
+                else:
+                    vectors = reconstruct_all(index, n)
+            if not alive.all():
+                # snapshot không chứa dòng tombstone (log chỉ tham chiếu theo tên tài liệu)
+                keep = np.flatnonzero(alive)
+                bm25.renumber({int(old): new for new, old in enumerate(keep)})
+                metas = [metas[i] for i in keep.tolist()]
+                texts = [texts[i] for i in keep.tolist()]
+                n = int(keep.size)
+                vectors = np.asarray(vectors)[keep] if n else None
+                index = build_index(target_kind(n), index.d, vectors)
+            if n:
+                os.makedirs(base, exist_ok=True)
+                faiss.write_index(index, self._index_file_path(base))
+                with open(self._vectors_file_path(base), "wb") as w:
+                    np.save(w, np.ascontiguousarray(vectors, dtype=np.float32))
+                with open(self._items_file_path(base), "w", encoding="utf-8") as w:
+                    for meta, text in zip(metas, texts):
+                        rec = {"meta": meta, "text": text}
+                        w.write(json.dumps(rec, ensure_ascii=False) + "\n")
+                bm25.save(self._bm25_file_path(base))
+                for fname in os.listdir(base):
+                    _fsync(os.path.join(base, fname))
+            # commit: store_meta (ghi atomic) chỉ định snapshot + segment <= upto đã nằm trong đó
+            meta_path = self._meta_file_path()
+            with open(meta_path + ".tmp", "w", encoding="utf-8") as w:
+                json.dump({"snapshot": rel if n else None, "segments_upto": upto, "n": n}, w)
+                w.flush()
+                os.fsync(w.fileno())
+            os.replace(meta_path + ".tmp", meta_path)
+            self._snapshot_base = base if n else None
+            self._remove_stale_files(keep=base if n else None, upto=upto)
+            print(f"Đã compaction store ({n} items) vào {base if n else self._folder()}")
         except Exception as e:
-            print(f"Lỗi lưu items metadata: {e}")
+            print(f"Lỗi compaction store: {e}")
+        finally:
+            self._compact_lock.release()
+
+    def _remove_stale_files(self, keep: str | None, upto: int):
+        """Sau commit: xoá snapshot cũ/dở dang, file snapshot kiểu cũ và segment <= upto."""
+        folder = self._snapshots_dir()
+        for name in os.listdir(folder) if os.path.isdir(folder) else []:
+            path = os.path.join(folder, name)
+            if path != keep:
+                shutil.rmtree(path, ignore_errors=True)
+        legacy = self._folder()
+        for path in (
+            self._index_file_path(legacy),
+            self._vectors_file_path(legacy),
+            self._items_file_path(legacy),
+            self._bm25_file_path(legacy),
+        ):
+            if os.path.exists(path):
+                os.remove(path)
+        for gen in self._list_segments():
+            if gen > upto:
+                continue
+            for path in self._segment_paths(gen):
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def _wipe_files(self):
+        """Xoá toàn bộ file lưu trữ của store (snapshot + segment)."""
+        legacy = self._folder()
+        for path in (
+            self._index_file_path(legacy),
+            self._vectors_file_path(legacy),
+            self._items_file_path(legacy),
+            self._bm25_file_path(legacy),
+            self._meta_file_path(),
+        ):
+            try:
+                if os.path.exists(path):
+                    os.remove(path)
+            except Exception as e:
+                print(f"Lỗi xoá file store {path}: {e}")
+        shutil.rmtree(self._snapshots_dir(), ignore_errors=True)
+        shutil.rmtree(self._segments_dir(), ignore_errors=True)
+        self._snapshot_base = None
+        self._active_gen = 0
+        self._log_records = 0
+        self._snapshot_n = 0
 
     def _mmr(
         self, query_vec: np.ndarray, cand_ix: np.ndarray, k: int, lambda_: float = 0.5
     ) -> List[int]:
         """Maximal Marginal Relevance để đa dạng hoá kết quả."""
-        chosen: List[int] = []
-        cand = list(cand_ix)
-        cand_sims = [float(np.dot(self.items[i].vec, query_vec)) for i in cand]
-
-        while cand and len(chosen) < k:
-            # lợi ích = lambda * sim(q, i) - (1-lambda) * max_j sim(i, j) với j đã chọn
-            best_i = None
-            best_score = -1e9
-            for idx, i in enumerate(cand):
-                rep = 0.0
-                if chosen:
-                    rep = max(
-                        float(np.dot(self.items[i].vec, self.items[j].vec))
-                        for j in chosen
-                    )
-                score = lambda_ * cand_sims[idx] - (1 - lambda_) * rep
-                if score > best_score:
-                    best_score, best_i = score, i
-            chosen.append(best_i)
-            cand.remove(best_i)
-        return chosen
+        cand = np.asarray(cand_ix, dtype=np.int64)
+        cand_vecs = self.exact_vectors(cand)
+        picked = mmr_select(cand_vecs, cand_vecs @ query_vec, k=k, lambda_=lambda_)
+        return cand[picked].tolist()
 
     def search(
-        self, query_vec: np.ndarray, top_k: int = 8, mmr_lambda: float = 0.5
+        self,
+        query_vec: np.ndarray,
+        top_k: int = 8,
+        mmr_lambda: float = 0.5,
+        nprobe: int | None = None,
+        ef_search: int | None = None,
+        docs=None,
     ) -> List[Chunk]:
-        if self.index.ntotal == 0:
-            return []
-        if query_vec.shape[0] != self.index.d:
-            print(
-                f"Bỏ qua search: query dim {query_vec.shape[0]} != index dim {self.index.d}"
-            )
-            return []
-        # đảm bảo có items metadata; nếu thiếu, thử tải từ disk
-        if not self.items or len(self.items) < int(self.index.ntotal):
-            self._try_load_items_from_disk()
-            if not self.items or len(self.items) < int(self.index.ntotal):
-                # không đủ metadata → trả rỗng để tránh lỗi
-                print("Thiếu metadata items so với index; bỏ qua kết quả để tránh lỗi.")
+        """Dense search + MMR; `docs` giới hạn kết quả trong các tài liệu được chọn."""
+        with self.lock:
+            if self.index.ntotal == 0:
+                return []
+            self._finish_purge()
+            if query_vec.shape[0] != self.index.d:
+                print(
+                    f"Bỏ qua search: query dim {query_vec.shape[0]} != index dim {self.index.d}"
+                )
+                return []
+            # đảm bảo có items metadata; nếu thiếu, thử tải từ disk
+            if self._n < int(self.index.ntotal):
+                self._try_load_items_from_disk()
+                if self._n < int(self.index.ntotal):
+                    # không đủ metadata → trả rỗng để tránh lỗi
+                    print("Thiếu metadata items so với index; bỏ qua kết quả để tránh lỗi.")
+                    return []
+            cand_ix = self.dense_candidates(
+                query_vec,
+                max(top_k * 3, top_k),
+                nprobe=nprobe,
+                ef_search=ef_search,
+                docs=docs,
+            ).tolist()
+            if not cand_ix:
                 return []
-        D, I = self.index.search(
-            query_vec.reshape(1, -1).astype("float32"), max(top_k * 3, top_k)
-        )
-        cand_ix = [int(i) for i in I[0] if i >= 0]
-        if not cand_ix:
-            return []
 
-        picked = self._mmr(query_vec, cand_ix, k=top_k, lambda_=mmr_lambda)
-        out: List[Chunk] = []
-        for i in picked:
-            it = self.items[i]
-            cos = float(np.dot(it.vec, query_vec))
-            score_norm = (cos + 1.0) / 2.0
-            meta = dict(it.meta or {})
-            meta.update(
-                {
-                    "dense_score_raw": cos,
-                    "dense_score": score_norm,
-                }
-            )
-            out.append(
-                Chunk(
-                    doc_name=meta["doc"],
-                    page=meta["page"],
-                    chunk_id=meta["chunk_id"],
-                    text=it.text,
-                    n_tokens=0,
-                    score=score_norm,
-                    meta=meta,
+            picked = self._mmr(query_vec, cand_ix, k=top_k, lambda_=mmr_lambda)
+            cos_all = self.exact_vectors(picked) @ query_vec
+            out: List[Chunk] = []
+            for i, cos in zip(picked, cos_all.tolist()):
+                score_norm = (cos + 1.0) / 2.0
+                meta = dict(self.metas[i] or {})
+                meta.update(
+                    {
+                        "dense_score_raw": cos,
+                        "dense_score": score_norm,
+                    }
                 )
-            )
-        return out
+                out.append(
+                    Chunk(
+                        doc_name=meta["doc"],
+                        page=meta["page"],
+                        chunk_id=meta["chunk_id"],
+                        text=self.texts[i],
+                        n_tokens=0,
+                        score=score_norm,
+                        meta=meta,
+                    )
+                )
+            return out
 
     def list_docs(self):
-        self._ensure_items_loaded()
-        return sorted(self.docs_set)
+        with self.lock:
+            self._ensure_items_loaded()
+            return sorted(self.docs_set)
 
     def clear(self):
-        self.index.reset()
-        self.items.clear()
-        self.docs_set = set()
-
-    def _rebuild_index_from_items(self):
-        if self.items:
-            mat = np.vstack([it.vec for it in self.items]).astype("float32")
-            dim = mat.shape[1]
-            self._dim = dim
-            self.index = faiss.IndexFlatIP(dim)
-            self.index.add(mat)
-            faiss.write_index(self.index, self.db_path)
-            print(f"Đã cập nhật index sau khi xoá tài liệu: {self.db_path}")
-        else:
-            self.index = faiss.IndexFlatIP(self._dim)
-            self.index.reset()
-            try:
-                if os.path.exists(self.db_path):
-                    os.remove(self.db_path)
-            except Exception as e:
-                print(f"Lỗi xoá index file: {e}")
+        with self.lock:
+            # chờ compaction đang chạy (nếu có) để không ghi lại file sau khi xoá
+            with self._compact_lock:
+                self._purge_job = None
+                self.index.reset()
+                self._init_columns(self.index.d)
+                self.bm25.clear()
 
     def remove_doc(self, doc_name: str) -> int:
-        self._ensure_items_loaded()
+        with self.lock:
+            self._ensure_items_loaded()
+            self._finish_purge()
+            if not doc_name or doc_name not in self.docs_set:
+                return 0
+            rows = self.doc_rows([doc_name])
+            if rows.size == 0:
+                return 0
+            if self.size() == rows.size:
+                removed = self._apply_remove(doc_name)
+                self.clear()
+                with self._compact_lock:
+                    self._wipe_files()
+                return removed
+            # ghi tombstone trước khi áp vào RAM (lỗi ghi → remove_doc thất bại, store giữ nguyên)
+            self._append_log_tombstone(doc_name, int(rows.size))
+            removed = self._apply_remove(doc_name)
+            self._maybe_purge()
+            self._maybe_compact()
+            return removed
+
+    def _apply_remove(self, doc_name: str | None) -> int:
+        """Đánh dấu tombstone các dòng của tài liệu; O(số chunk bị xoá)."""
         if not doc_name or doc_name not in self.docs_set:
             return 0
 
-        remaining = [item for item in self.items if item.meta.get("doc") != doc_name]
-        removed = len(self.items) - len(remaining)
+        removed_rows = self.doc_rows([doc_name]).tolist()
+        removed = len(removed_rows)
         if removed == 0:
             return 0
 
-        self.items = remaining
-        self.docs_set = {it.meta.get("doc") for it in self.items if it.meta.get("doc")}
-        self._rebuild_index_from_items()
-        self._persist_items()
+        self.bm25.remove(removed_rows, [self.texts[i] for i in removed_rows])
+        self._alive[removed_rows] = False
+        self._dead += removed
+        self.docs_set.discard(doc_name)
         return removed
 
+    # ---- purge tombstone ----
+    def _maybe_purge(self):
+        if not self._dead or self._purge_job is not None:
+            return
+        threshold = max(
+            get_int("STORE_PURGE_MIN_ROWS", 256),
+            int(get_float("STORE_PURGE_RATIO", 0.2) * self._n),
+        )
+        if self._dead >= threshold:
+            self.purge(background=True)
+
+    def purge(self, background: bool = True):
+        """
+        Xoá vật lý các dòng tombstone (không có tombstone: chỉ dựng lại index theo
+        target_kind, dùng khi nâng index). Index mới được dựng (nền nếu
+        `background=True`) từ vector các dòng còn sống; store chuyển sang index
+        mới ở thao tác add/xoá/search kế tiếp (_finish_purge).
+        """
+        rows = np.flatnonzero(self.alive)
+        if rows.size == self._n and not self.quantized:
+            # không có tombstone (nâng index): view các dòng hiện có, không bị ghi đè tại chỗ
+            vecs = self.vectors
+        else:
+            vecs = self.exact_vectors(rows)
+        kind, dim = target_kind(int(rows.size)), int(self._vecs.shape[1])
+        job = {
+            "rows": rows,
+            "n": self._n,
+            "epoch": self._epoch,
+            "index": None,
+            "done": threading.Event(),
+        }
+
+        def _build():
+            try:
+                job["index"] = build_index(kind, dim, vecs if rows.size else None)
+            except Exception as e:
+                print(f"Lỗi dựng index khi purge tombstone: {e}")
+            finally:
+                job["done"].set()
+
+        self._purge_job = job
+        if background:
+            threading.Thread(target=_build, daemon=True).start()
+        else:
+            _build()
+            self._finish_purge()
+
+    def _finish_purge(self, wait: bool = False):
+        """Áp job purge đã xong: bỏ dòng tombstone, dùng index mới + các dòng thêm sau đó."""
+        job = self._purge_job
+        if job is None or (not job["done"].is_set() and not wait):
+            return
+        job["done"].wait()
+        self._purge_job = None
+        if job["index"] is None or job["epoch"] != self._epoch:
+            return
+        n0 = job["n"]
+        # dòng thêm sau khi job bắt đầu chưa có trong index mới
+        tail = np.arange(n0, self._n, dtype=np.int64)
+        tail_vecs = self.exact_vectors(tail)
+        keep = np.concatenate([job["rows"], tail])
+        dropped = self._n - int(keep.size)
+        if dropped:
+            self.bm25.renumber({int(old): new for new, old in enumerate(keep)})
+            self._keep_rows(keep)
+        index = job["index"]
+        if tail.size:
+            index.add(tail_vecs)
+        self.index = index
+        if dropped:
+            print(f"Đã purge {dropped} dòng tombstone ({self._n} dòng còn lại)")
+        else:
+            print(f"Đã chuyển sang FAISS index {self.index_kind} ({self._n} vectors)")
+        self._maybe_promote()
+        # tombstone phát sinh trong lúc job chạy
+        self._maybe_purge()
+
+
+class _StoreCache:
+    """
+    Cache các FAISSStore đã mở theo session (LRU).
+    - VECTOR_STORE_CACHE_MB: ngân sách RAM ước lượng (vector, index, text, meta, BM25);
+      vượt thì bỏ store ít dùng nhất (0 = không giới hạn)
+    - VECTOR_STORE_CACHE_IDLE_S: bỏ store không được dùng quá N giây (0 = tắt)
+    Store bị bỏ chỉ mất bản trong RAM (dữ liệu đã nằm trong snapshot + segment log),
+    lần truy cập sau sẽ tải lại từ disk.
+    """
+
+    def __init__(self):
+        self._items: "OrderedDict[str, FAISSStore]" = OrderedDict()
+        self._last_used: Dict[str, float] = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions_budget = 0
+        self.evictions_idle = 0
+
+    def __contains__(self, session_id: str) -> bool:
+        return session_id in self._items
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def get(self, session_id: str) -> FAISSStore | None:
+        store = self._items.get(session_id)
+        if store is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._touch(session_id)
+        return store
+
+    def put(self, session_id: str, store: FAISSStore) -> None:
+        self._items[session_id] = store
+        self._touch(session_id)
 
-# Singleton store (khởi tạo lazy sau khi biết dim)
-_stores: Dict[str, FAISSStore] = {}
+    def pop(self, session_id: str, default=None):
+        self._last_used.pop(session_id, None)
+        return self._items.pop(session_id, default)
+
+    def clear(self) -> None:
+        self._items.clear()
+        self._last_used.clear()
+
+    def _touch(self, session_id: str) -> None:
+        self._items.move_to_end(session_id)
+        self._last_used[session_id] = time.monotonic()
+
+    def total_bytes(self) -> int:
+        return sum(s.memory_bytes() for s in self._items.values())
+
+    def enforce(self, keep: str | None = None) -> None:
+        """Bỏ store idle quá hạn, rồi bỏ theo LRU tới khi dưới ngân sách (trừ `keep`)."""
+        idle_s = get_float("VECTOR_STORE_CACHE_IDLE_S", 1800.0)
+        if idle_s > 0:
+            now = time.monotonic()
+            for sid in list(self._items):
+                if sid != keep and now - self._last_used.get(sid, now) > idle_s:
+                    if self._evict(sid):
+                        self.evictions_idle += 1
+        budget = get_int("VECTOR_STORE_CACHE_MB", 1024) * 1024 * 1024
+        if budget <= 0:
+            return
+        sizes = {sid: s.memory_bytes() for sid, s in self._items.items()}
+        total = sum(sizes.values())
+        # OrderedDict: đầu = ít dùng nhất
+        for sid in list(self._items):
+            if total <= budget:
+                break
+            if sid != keep and self._evict(sid):
+                self.evictions_budget += 1
+                total -= sizes[sid]
+
+    def _evict(self, session_id: str) -> bool:
+        store = self._items.get(session_id)
+        if store is None or store.busy:
+            return False
+        self.pop(session_id)
+        print(f"Bỏ vector store session {session_id} khỏi cache")
+        return True
+
+    def stats(self) -> Dict:
+        lookups = self.hits + self.misses
+        return {
+            "stores": len(self._items),
+            "bytes": self.total_bytes(),
+            "budget_bytes": get_int("VECTOR_STORE_CACHE_MB", 1024) * 1024 * 1024,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions_budget": self.evictions_budget,
+            "evictions_idle": self.evictions_idle,
+        }
+
+
+# Cache store theo session (khởi tạo lazy sau khi biết dim); _StoreCache không
+# thread-safe nên mọi truy cập đi qua _stores_lock
+_stores = _StoreCache()
+_stores_lock = threading.Lock()
 
 
 def _uploads_dir() -> str:
     return os.getenv("UPLOAD_DIR", "./uploads")
 
 
-def _store_paths(session_id: str) -> tuple[str, str, str]:
+def _store_paths(session_id: str) -> tuple[str, str, str, str, str, str]:
     base = _uploads_dir()
     folder = os.path.join(base, session_id)
     return (
         folder,
         os.path.join(folder, "faiss_index.bin"),
+        os.path.join(folder, "vectors.npy"),
         os.path.join(folder, "items.jsonl"),
+        os.path.join(folder, "bm25_index.json"),
+        os.path.join(folder, "store_meta.json"),
     )
 
 
 def get_store(session_id: str, dim: int = 768) -> FAISSStore:
     """Lấy/tạo vector store cho session cụ thể."""
-    if session_id in _stores:
-        return _stores[session_id]
+    with _stores_lock:
+        store = _stores.get(session_id)
+        if store is None:
+            # Nếu chưa có trong cache, tạo mới từ file hoặc tạo rỗng
+            folder, index_path = _store_paths(session_id)[:2]
+            os.makedirs(folder, exist_ok=True)
+
+            store = FAISSStore(db_path=index_path, dim=dim)
+            _stores.put(session_id, store)
+        _stores.enforce(keep=session_id)
+        return store
 
-    # Nếu chưa có trong cache, tạo mới từ file hoặc tạo rỗng
-    folder, index_path, _ = _store_paths(session_id)
-    os.makedirs(folder, exist_ok=True)
 
-    store = FAISSStore(db_path=index_path, dim=dim)
-    _stores[session_id] = store
-    return store
+def store_cache_stats() -> Dict:
+    """Số liệu cache store theo session (hit/miss/eviction, byte ước lượng)."""
+    with _stores_lock:
+        return _stores.stats()
 
 
 def drop_store(session_id: str) -> None:
     """Loại bỏ store đã được cache của session (nếu có)."""
-    store = _stores.pop(session_id, None)
+    with _stores_lock:
+        store = _stores.pop(session_id, None)
     if store:
         try:
             store.clear()
         except Exception:
             pass
 
-    folder, index_path, items_path = _store_paths(session_id)
-    for path in (index_path, items_path):
+    folder, *paths = _store_paths(session_id)
+    for path in paths:
         try:
             if os.path.exists(path):
                 os.remove(path)
         except Exception:
             pass
+    shutil.rmtree(os.path.join(folder, "segments"), ignore_errors=True)
+    shutil.rmtree(os.path.join(folder, "snapshots"), ignore_errors=True)
     # nếu folder trống sau khi xoá index, giữ nguyên (PDFs vẫn dùng)
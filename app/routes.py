@@ -1,5 +1,4 @@
-import os, uuid, json, time, shutil, math, re
-import numpy as np
+import os, uuid, json, time, shutil, math, re, threading, asyncio
 from typing import List
 from fastapi import APIRouter, Request, UploadFile, File, Form, BackgroundTasks
 from fastapi.responses import JSONResponse, HTMLResponse, PlainTextResponse
@@ -13,9 +12,11 @@ from app.utils.logger import app_logger
 from app.utils.schema import Chunk
 from app.utils.config import get_int, get_float, get_bool
 from app.rag.pdf_loader import load_pdf
-from app.rag.chunking import chunk_pages
-from app.rag.embeddings import embed_texts
-from app.rag.vectorstore import get_store, drop_store
+from app.rag import ingest_pipeline
+from app.rag.embeddings import aembed_texts, aembed_query, query_batch_stats
+from app.rag import embed_client
+from app.rag.cache import cache_stats as embed_cache_stats
+from app.rag.vectorstore import get_store, drop_store, store_cache_stats
 from app.rag.hybrid import hybrid_retrieve
 from app.rag.rerank import rerank
 from app.rag.generator import generate
@@ -203,9 +204,11 @@ def _session_snapshot(session_id: str) -> dict:
         )
 
     has_vector_store = False
+    vector_memory = None
     try:
         store = get_store(session_id=session_id, dim=768)
         has_vector_store = store.size() > 0
+        vector_memory = store.memory_report()
     except Exception:
         has_vector_store = False
 
@@ -217,6 +220,7 @@ def _session_snapshot(session_id: str) -> dict:
         "files": existing_files,
         "manifest": manifest,
         "has_vector_store": has_vector_store,
+        "vector_memory": vector_memory,
         "can_ask": has_vector_store and len(existing_files) > 0,
         "chats": chats,
     }
@@ -385,38 +389,66 @@ async def ingest(
 
     docs_summary: list[dict] = []
     new_docs_summary: list[dict] = []
-    total_chunks_new = 0
-    all_chunks: List[Chunk] = []
     skipped_docs: list[str] = []
+    new_files: list[str] = []
 
     for fname in sorted(os.listdir(folder)):
         if not fname.lower().endswith(".pdf"):
             continue
-        fpath = os.path.join(folder, fname)
-
         if fname in existing_docs_map:
             docs_summary.append(existing_docs_map[fname])
             skipped_docs.append(fname)
             continue
+        new_files.append(fname)
+
+    if not new_files:
+        # Không có tài liệu mới để xử lý, trả về thông tin hiện có
+        existing_docs = list(existing_docs_map.values())
+        existing_docs.sort(key=lambda d: d.get("doc", ""))
+        latency = int((time.time() - t0) * 1000)
+        return {
+            "ingested": [],
+            "total_chunks": 0,
+            "overall_chunks": sum(d.get("chunks", 0) for d in existing_docs),
+            "docs": existing_docs,
+            "skipped": skipped_docs,
+            "message": "Không có tài liệu mới cần xử lý.",
+            "latency_ms": latency,
+        }
+
+    tracker_lock = threading.Lock()
 
+    def _extract(fname: str):
         # 1) Load PDF (OCR nếu cần)
+        fpath = os.path.join(folder, fname)
         with open(fpath, "rb") as pdf_file:
             pdf_bytes = pdf_file.read()
-        pages = load_pdf(pdf_bytes, ocr=bool(ocr), ocr_lang="vie+eng")
+        # truyền đường dẫn: worker trích text song song tự mở file, không cần file tạm
+        load_stats: dict = {}
+        pages = load_pdf(fpath, ocr=bool(ocr), ocr_lang="vie+eng", stats=load_stats)
+        ocr_pages = load_stats.get("ocr_pages") or []
+        if ocr_pages:
+            app_logger.info(
+                "[ingest] OCR '%s': %d trang, %d ms, từng trang: %s",
+                fname,
+                len(ocr_pages),
+                load_stats.get("ocr_ms", 0),
+                ocr_pages,
+            )
 
         # 1.5) Register document và detect version/duplicate ← NEW
         normalized_text = " ".join(text for _, text in pages)
         chunk_ids_placeholder = []  # Will be updated after chunking
 
-        doc_status, doc_message, superseded_doc = doc_tracker.register_document(
-            filename=fname,
-            raw_content=pdf_bytes,
-            normalized_text=normalized_text,
-            pages=pages,
-            chunk_ids=chunk_ids_placeholder,
-        )
-
-        doc_metadata = doc_tracker.get_document_metadata(fname)
+        with tracker_lock:
+            doc_status, doc_message, superseded_doc = doc_tracker.register_document(
+                filename=fname,
+                raw_content=pdf_bytes,
+                normalized_text=normalized_text,
+                pages=pages,
+                chunk_ids=chunk_ids_placeholder,
+            )
+            doc_metadata = doc_tracker.get_document_metadata(fname)
         upload_timestamp = (
             doc_metadata.upload_timestamp if doc_metadata else time.time()
         )
@@ -426,94 +458,150 @@ async def ingest(
         app_logger.info(
             "[ingest] Document '%s': %s - %s", fname, doc_status, doc_message
         )
-
-        # 2) Chunk token-aware với enhanced metadata ← UPDATED
-        chunks = chunk_pages(
-            pages,
-            doc_name=fname,
-            chunk_size=CHUNK_SIZE,
-            overlap=CHUNK_OVERLAP,
-            upload_timestamp=upload_timestamp,  # ← NEW
-            document_status=document_status,  # ← NEW
-            document_version=document_version,  # ← NEW
-        )
-        if len(chunks) == 0:
-            return JSONResponse(
-                status_code=400,
-                content={
-                    "error": f"Không tạo được chunk nào cho tài liệu {fname}. Kiểm tra PDF / OCR."
-                },
-            )
-        total_chunks_new += len(chunks)
-        all_chunks.extend(chunks)
-        doc_summary = {
+        meta = {
+            "upload_timestamp": upload_timestamp,  # ← NEW
+            "document_status": document_status,  # ← NEW
+            "document_version": document_version,  # ← NEW
+        }
+        info = {
             "doc": fname,
-            "pages": len(pages),
-            "chunks": len(chunks),
             "status": doc_status,  # ← NEW
             "message": doc_message,  # ← NEW
             "upload_timestamp": upload_timestamp,  # ← NEW
             "document_status": document_status,  # ← NEW
             "version": document_version,  # ← NEW
+            "extract_ms": load_stats.get("extract_ms", 0),
+            "ocr_pages": len(ocr_pages),
+            "ocr_ms": load_stats.get("ocr_ms", 0),
         }
-        docs_summary.append(doc_summary)
-        new_docs_summary.append(doc_summary)
-
-    if total_chunks_new == 0:
-        # Không có tài liệu mới để xử lý, trả về thông tin hiện có
-        existing_docs = list(existing_docs_map.values())
-        existing_docs.sort(key=lambda d: d.get("doc", ""))
-        latency = int((time.time() - t0) * 1000)
-        return {
-            "ingested": [],
-            "total_chunks": 0,
-            "overall_chunks": sum(d.get("chunks", 0) for d in existing_docs),
-            "docs": existing_docs,
-            "skipped": skipped_docs,
-            "message": "Không có tài liệu mới cần xử lý.",
-            "latency_ms": latency,
-        }
+        return fname, pages, meta, info
 
-    # 3) Embed theo batch
-    B = 64
-    vecs_list = []
-    for i in range(0, len(all_chunks), B):
-        batch_texts = [c.text for c in all_chunks[i : i + B]]
-        vecs = embed_texts(batch_texts)
-        vecs_list.append(vecs)
-    vectors = (np.vstack(vecs_list)).astype("float32")
-    app_logger.info("Embed vectors: %s chunks: %d", vectors.shape, len(all_chunks))
-
-    # 4) Upsert vào vector store
-    store = get_store(session_id=session_id, dim=vectors.shape[1])
-    store.add(vectors, all_chunks)
-
-    # 5) Ghi manifest (kết hợp với tài liệu đã xử lý trước đó)
-    docs_by_name: dict[str, dict] = {}
-    for doc in docs_summary:
-        name = doc.get("doc")
-        if name:
-            docs_by_name[name] = doc
-    for name, doc in existing_docs_map.items():
-        if name not in docs_by_name:
-            docs_by_name[name] = doc
-    combined_docs = sorted(docs_by_name.values(), key=lambda d: d.get("doc", ""))
-
-    # Get document tracking statistics ← NEW
-    doc_stats = doc_tracker.get_statistics()
+    def _chunk(doc):
+        # 2) Chunk token-aware với enhanced metadata, chia batch INGEST_BATCH_CHUNKS
+        fname, pages, meta, info = doc
+        return ingest_pipeline.split_batches(
+            fname, pages, meta, info, CHUNK_SIZE, CHUNK_OVERLAP, batch_chunks
+        )
 
-    manifest = {
-        "session_id": session_id,
-        "docs": combined_docs,
-        "total_chunks": sum(d.get("chunks", 0) for d in combined_docs),
-        "ts": int(time.time()),
-        "ocr": bool(ocr),
-        "chunk_size": CHUNK_SIZE,
-        "chunk_overlap": CHUNK_OVERLAP,
-        "document_stats": doc_stats,  # ← NEW
-    }
-    with open(manifest_path, "w", encoding="utf-8") as w:
-        json.dump(manifest, w, ensure_ascii=False, indent=2)
+    async def _embed(batch: ingest_pipeline.DocBatch):
+        # 3) Embed batch (aembed_texts tự chia request, gọi song song ngoài event loop;
+        #    batch đã embed được ghi cache ngay nên ingest lại sau lỗi không phải embed lại)
+        vectors = (await aembed_texts([c.text for c in batch.chunks])).astype("float32")
+        return batch, vectors
+
+    stored_batches: dict[str, int] = {}
+
+    def _store(item):
+        # 4) Upsert ngay vào vector store: tài liệu tìm được khi batch của nó vào store
+        #    (hàm sync → chạy qua to_thread; store.add tự giữ store.lock)
+        batch, vectors = item
+        store = get_store(session_id=session_id, dim=vectors.shape[1])
+        store.add(vectors, batch.chunks)
+        partial_docs.add(batch.doc_name)
+        stored_batches[batch.doc_name] = stored_batches.get(batch.doc_name, 0) + 1
+        if stored_batches[batch.doc_name] == batch.total:
+            partial_docs.discard(batch.doc_name)
+            info = batch.info
+            doc_summary = {
+                "doc": info["doc"],
+                "pages": info["pages"],
+                "chunks": info["chunks"],
+                "status": info["status"],
+                "message": info["message"],
+                "upload_timestamp": info["upload_timestamp"],
+                "document_status": info["document_status"],
+                "version": info["version"],
+                "extract_ms": info["extract_ms"],
+                "ocr_pages": info["ocr_pages"],
+                "ocr_ms": info["ocr_ms"],
+            }
+            docs_summary.append(doc_summary)
+            new_docs_summary.append(doc_summary)
+            app_logger.info("[ingest] Stored '%s': %d chunks", info["doc"], info["chunks"])
+
+    partial_docs: set[str] = set()
+
+    def _drop_partial():
+        # tài liệu mới vào store một phần (lỗi giữa chừng) → gỡ ra để lần ingest sau không bị trùng
+        for name in list(partial_docs):
+            get_store(session_id).remove_doc(name)
+
+    def _write_manifest() -> dict:
+        # 5) Ghi manifest (kết hợp với tài liệu đã xử lý trước đó)
+        docs_by_name: dict[str, dict] = {}
+        for doc in docs_summary:
+            name = doc.get("doc")
+            if name:
+                docs_by_name[name] = doc
+        for name, doc in existing_docs_map.items():
+            if name not in docs_by_name:
+                docs_by_name[name] = doc
+        combined_docs = sorted(docs_by_name.values(), key=lambda d: d.get("doc", ""))
+
+        # Get document tracking statistics ← NEW
+        doc_stats = doc_tracker.get_statistics()
+
+        manifest = {
+            "session_id": session_id,
+            "docs": combined_docs,
+            "total_chunks": sum(d.get("chunks", 0) for d in combined_docs),
+            "ts": int(time.time()),
+            "ocr": bool(ocr),
+            "chunk_size": CHUNK_SIZE,
+            "chunk_overlap": CHUNK_OVERLAP,
+            "document_stats": doc_stats,  # ← NEW
+        }
+        with open(manifest_path, "w", encoding="utf-8") as w:
+            json.dump(manifest, w, ensure_ascii=False, indent=2)
+        return manifest
+
+    # Pipeline nhiều tầng chạy gối nhau (đọc PDF → chunk → embed → ghi store), mỗi tầng
+    # có số worker riêng và hàng đợi có giới hạn giữa các tầng; bộ nhớ không tăng theo cả lô upload
+    batch_chunks = get_int("INGEST_BATCH_CHUNKS", 256)
+    stages = [
+        ingest_pipeline.Stage(
+            "extract", _extract, workers=get_int("INGEST_EXTRACT_WORKERS", 1)
+        ),
+        ingest_pipeline.Stage(
+            "chunk", _chunk, workers=get_int("INGEST_CHUNK_WORKERS", 2), fan_out=True
+        ),
+        ingest_pipeline.Stage(
+            "embed", _embed, workers=get_int("INGEST_EMBED_WORKERS", 4)
+        ),
+        # store không an toàn khi ghi song song → một worker
+        ingest_pipeline.Stage("store", _store, workers=1),
+    ]
+    try:
+        stage_timings = await ingest_pipeline.run_stages(
+            new_files, stages, max_queued=get_int("INGEST_QUEUE_BATCHES", 4)
+        )
+    except ingest_pipeline.EmptyDocument as e:
+        # tài liệu trước đó đã vào store → vẫn ghi manifest cho khớp
+        _drop_partial()
+        _write_manifest()
+        return JSONResponse(
+            status_code=400,
+            content={
+                "error": f"Không tạo được chunk nào cho tài liệu {e.doc_name}. Kiểm tra PDF / OCR."
+            },
+        )
+    except embed_client.EmbeddingUnavailable as e:
+        _drop_partial()
+        _write_manifest()
+        return JSONResponse(status_code=503, content={"error": str(e)})
+    except Exception:
+        _drop_partial()
+        _write_manifest()
+        raise
+
+    new_docs_summary.sort(key=lambda d: d.get("doc", ""))
+    total_chunks_new = sum(d["chunks"] for d in new_docs_summary)
+    app_logger.info(
+        "[ingest] Stored %d new chunks, stages: %s", total_chunks_new, stage_timings
+    )
+    manifest = _write_manifest()
+    combined_docs = manifest["docs"]
+    doc_stats = manifest["document_stats"]
 
     latency = int((time.time() - t0) * 1000)
     result = {
@@ -523,6 +611,7 @@ async def ingest(
         "docs": combined_docs,
         "skipped": skipped_docs,
         "latency_ms": latency,
+        "stages": stage_timings,
         "document_stats": doc_stats,  # ← NEW
     }
 
@@ -573,7 +662,7 @@ async def delete_uploaded_file(session_id: str, doc_name: str):
         )
 
     store = get_store(session_id)
-    removed_vectors = store.remove_doc(safe_name)
+    removed_vectors = await asyncio.to_thread(store.remove_doc, safe_name)
 
     manifest_path = os.path.join(folder, MANIFEST_NAME)
     manifest: dict = {
@@ -629,6 +718,8 @@ async def ask(
     session_id: str = Form(...),
     selected_docs: str | None = Form(None),
     chat_id: str | None = Form(None),
+    nprobe: int | None = Form(None),
+    ef_search: int | None = Form(None),
 ):
     # Validation đầu vào
     if not query or not query.strip():
@@ -714,7 +805,7 @@ async def ask(
 
         # Chuẩn bị thông tin cho cache
         store = get_store(session_id=session_id)
-        available_docs = store.list_docs()
+        available_docs = await asyncio.to_thread(store.list_docs)
 
         # 0) Kiểm tra answer cache trước
         if ENABLE_ANSWER_CACHE:
@@ -750,7 +841,7 @@ async def ask(
                 }
         # 1) Embed query
         app_logger.info("Embedding query...")
-        qvec = embed_texts([query])[0]
+        qvec = (await aembed_query(query))[0]
 
         # 2) Parse selected docs once
         allow_docs = None
@@ -763,26 +854,39 @@ async def ask(
                 )
 
         # 3) Retrieve (hybrid hoặc vector-only) với recency boost ← UPDATED
+        #    chạy ngoài event loop, giữ store.lock để không đọc store giữa một lần add
         app_logger.info("Retrieving relevant passages...")
-        if HYBRID_ON:
-            app_logger.info("Using hybrid search (BM25 + Vector) with recency boost...")
-            retrieved = hybrid_retrieve(
-                query_vec=qvec,
-                query_text=query.strip(),
-                store=store,
-                docs=list(allow_docs) if allow_docs else None,
-                top_k=TOP_K,
-                alpha=HYBRID_ALPHA,
-                mmr_lambda=MMR_LAMBDA,
-                recency_weight=RECENCY_WEIGHT,  # ← NEW
-                recency_mode=RECENCY_MODE,  # ← NEW
-            )
-        else:
-            app_logger.info("Using vector search only...")
-            retrieved = store.search(qvec, top_k=TOP_K, mmr_lambda=MMR_LAMBDA)
 
-        if allow_docs and not HYBRID_ON:
-            retrieved = [c for c in retrieved if c.doc_name in allow_docs]
+        def _retrieve():
+            with store.lock:
+                if HYBRID_ON:
+                    app_logger.info(
+                        "Using hybrid search (BM25 + Vector) with recency boost..."
+                    )
+                    return hybrid_retrieve(
+                        query_vec=qvec,
+                        query_text=query.strip(),
+                        store=store,
+                        docs=list(allow_docs) if allow_docs else None,
+                        top_k=TOP_K,
+                        alpha=HYBRID_ALPHA,
+                        mmr_lambda=MMR_LAMBDA,
+                        recency_weight=RECENCY_WEIGHT,  # ← NEW
+                        recency_mode=RECENCY_MODE,  # ← NEW
+                        nprobe=nprobe,
+                        ef_search=ef_search,
+                    )
+                app_logger.info("Using vector search only...")
+                return store.search(
+                    qvec,
+                    top_k=TOP_K,
+                    mmr_lambda=MMR_LAMBDA,
+                    nprobe=nprobe,
+                    ef_search=ef_search,
+                    docs=list(allow_docs) if allow_docs else None,
+                )
+
+        retrieved = await asyncio.to_thread(_retrieve)
 
         # 4) (optional) Rerank
         app_logger.info("Reranking...")
@@ -947,6 +1051,8 @@ async def ask(
             "chat": chat_meta,
             "format": "markdown",
         }
+    except embed_client.EmbeddingUnavailable as e:
+        return JSONResponse(status_code=503, content={"error": str(e)})
     except Exception as e:
         app_logger.exception("Error in /ask endpoint: %s", str(e))
         return JSONResponse(
@@ -1206,7 +1312,13 @@ async def docs():
 
 @router.get("/health")
 async def health():
-    return {"status": "ok"}
+    return {
+        "status": "ok",
+        "store_cache": store_cache_stats(),
+        "embed_client": embed_client.stats(),
+        "query_batcher": query_batch_stats(),
+        "embed_cache": embed_cache_stats(),
+    }
 
 
 # Alias để khớp tài liệu
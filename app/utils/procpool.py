@@ -0,0 +1,39 @@
+from __future__ import annotations
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+
+from app.utils.config import get_int
+
+# Process pool dùng chung cho các việc nặng CPU khi ingest (trích text/OCR PDF, chia chunk):
+# một pool PROCESS_POOL_WORKERS process thay vì mỗi module một pool cỡ số core.
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_lock = threading.Lock()
+
+
+def n_workers() -> int:
+    """Số process của pool (PROCESS_POOL_WORKERS, trống = số core)."""
+    return max(1, get_int("PROCESS_POOL_WORKERS", os.cpu_count() or 1))
+
+
+def get_pool() -> ProcessPoolExecutor:
+    """Pool dùng chung, tạo lazy ở lần gọi đầu."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # spawn: không fork process đang chạy thread (uvicorn, FAISS, pool embedding)
+            _pool = ProcessPoolExecutor(
+                max_workers=n_workers(), mp_context=multiprocessing.get_context("spawn")
+            )
+        return _pool
+
+
+def discard(pool: ProcessPoolExecutor) -> None:
+    """Bỏ pool bị hỏng (BrokenProcessPool); lần get_pool sau tạo pool mới."""
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
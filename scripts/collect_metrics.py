@@ -30,9 +30,16 @@ def print_embed_cache_stats(path):
     try:
         with sqlite3.connect(path) as conn:
             cur = conn.cursor()
-            cur.execute("SELECT count(*) FROM embeddings")
-            total = cur.fetchone()[0]
+            cur.execute("SELECT ns, count(*), sum(length(vec)) FROM embed_cache_v2 GROUP BY ns")
+            rows = cur.fetchall()
+            total = sum(r[1] for r in rows)
             print(f"Embed cache entries: {total}")
+            for ns, n, size in rows:
+                print(f"  {ns}: {n} entries, {size / 1e6:.1f} MB")
+            cur.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='embed_cache'")
+            if cur.fetchone():
+                cur.execute("SELECT count(*) FROM embed_cache")
+                print(f"  legacy embed_cache (no namespace): {cur.fetchone()[0]} entries")
     except Exception as e:
         print("Error reading embed cache:", e)
 
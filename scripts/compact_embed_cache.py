@@ -0,0 +1,43 @@
+"""Compact the embedding cache DB (drop dead namespaces / legacy table, cap size, VACUUM).
+Usage: python scripts/compact_embed_cache.py [--keep-namespace NS ...] [--drop-legacy]
+                                             [--max-mb N] [--dtype float16]
+"""
+
+import argparse
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from app.rag.cache import compact  # noqa: E402
+
+EMBED_DB = os.getenv("EMBED_CACHE_DB", "./storage/embed_cache.sqlite")
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__)
+    ap.add_argument("--db", default=EMBED_DB)
+    ap.add_argument("--keep-namespace", action="append", default=[],
+                    help="namespace to keep, e.g. 'gemini:text-embedding-004|retrieval_document' (repeatable)")
+    ap.add_argument("--drop-legacy", action="store_true", help="drop the old un-namespaced embed_cache table")
+    ap.add_argument("--max-mb", type=int, default=0, help="evict least recently used entries above this size")
+    ap.add_argument("--dtype", choices=["float32", "float16"], help="re-encode stored vectors")
+    args = ap.parse_args()
+
+    if not os.path.exists(args.db):
+        print("Embed cache DB not found:", args.db)
+        return
+    report = compact(
+        args.db,
+        max_bytes=args.max_mb * 1024 * 1024,
+        keep_namespaces=args.keep_namespace or None,
+        drop_legacy=args.drop_legacy,
+        to_dtype={"float32": "f4", "float16": "f2"}.get(args.dtype),
+    )
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+    print(f"Size: {report['bytes_before'] / 1e6:.1f} MB -> {report['bytes_after'] / 1e6:.1f} MB")
+
+
+if __name__ == "__main__":
+    main()